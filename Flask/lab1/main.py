@@ -1,7 +1,22 @@
-from flask import Flask
+from flask import Flask, Response, request, stream_with_context
 from flask_restful import Resource, Api, reqparse, abort
+from werkzeug.http import quote_etag
 
+import bisect
+import contextlib
+import gzip
 import json
+import os
+import sqlite3
+import sys
+import threading
+import uuid
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # Windows: ids are still unique within one process
+    fcntl = None
 
 app = Flask("VideoAPI")
 api = Api(app)
@@ -10,21 +25,623 @@ parser = reqparse.RequestParser()
 parser.add_argument('title', required = True)
 parser.add_argument('uploadDate', type=int, required = False)
 
+query_parser = reqparse.RequestParser()
+query_parser.add_argument('from', type=int, location='args')
+query_parser.add_argument('to', type=int, location='args')
+query_parser.add_argument('limit', type=int, location='args')
+query_parser.add_argument('cursor', location='args')
+query_parser.add_argument('order', choices=('asc', 'desc'), default='asc', location='args')
+
 '''videos = {
     'video1': {'title': 'Hello World in Python','uploadDate':20210917},
 
     'video2': { 'title': 'Why Matlab is the best language Ever','uploadDate':20211117 }
 }
 '''
-with open("videos.json", 'r') as f:
-    videos = json.load(f)
+VIDEOS_FILE = "videos.json"
+LOG_FILE = "videos.log"
+ID_FILE = "video_ids.json"
+DB_FILE = os.environ.get("VIDEO_DB", "videos.db")
+STORE_BACKEND = os.environ.get("VIDEO_STORE", "json")
+COMPACT_EVERY = 1000
+ID_BLOCK_SIZE = int(os.environ.get("VIDEO_ID_BLOCK_SIZE", 100))
+IMPORT_CHUNK_SIZE = 1000
+EXPORT_CHUNK_LINES = 1000
+
+class VideoLog:
+    """Append-only log of mutations on top of the videos.json snapshot.
+
+    Every write appends one JSON line and fsyncs it, so a write costs O(1)
+    instead of rewriting the whole catalog. Once the log grows past
+    `compact_every` entries it is rotated and folded into a new snapshot
+    on a background thread. The snapshot is written to a temp file and
+    swapped in with os.replace, so a crash never leaves it truncated.
+    """
+
+    def __init__(self, snapshot_path, log_path, compact_every=COMPACT_EVERY):
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path
+        self.old_log_path = log_path + ".old"
+        self.compact_every = compact_every
+        self.lock = threading.Lock()
+        self.entries = 0
+        self.applied = 0
+        self.compacting = None
+        self.failed_snapshot = None
+        self.log = None
+
+    def load(self):
+        videos = {}
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r') as f:
+                videos = json.load(f)
+        # A rotated log is only left behind if we crashed mid-compaction;
+        # replaying it over the snapshot is harmless since entries are idempotent.
+        if os.path.exists(self.old_log_path):
+            self.entries += self._replay(self.old_log_path, videos)
+        if os.path.exists(self.log_path):
+            self.entries += self._replay(self.log_path, videos)
+        if os.path.exists(self.old_log_path):
+            write_snapshot(self.snapshot_path, videos)
+            os.remove(self.old_log_path)
+        self.log = open(self.log_path, 'ab')
+        return videos
+
+    def _replay(self, path, videos):
+        count = 0
+        good_offset = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Torn write from a crash: drop it and everything after it
+                    break
+                apply_entry(videos, entry)
+                good_offset += len(line)
+                count += 1
+        if good_offset != os.path.getsize(path):
+            with open(path, 'r+b') as f:
+                f.truncate(good_offset)
+        return count
+
+    def append(self, entry, videos, index=None):
+        # A batch is written as a single line, so a torn write drops all of it
+        line = (json.dumps(entry) + "\n").encode()
+        with self.lock:
+            # Only apply once the line is durable, so a failed write never
+            # leaves readers seeing a change that vanishes on restart
+            offset = self.log.tell()
+            try:
+                self.log.write(line)
+                self.log.flush()
+                os.fsync(self.log.fileno())
+            except OSError:
+                self._discard_tail(offset)
+                raise
+            apply_entry(videos, entry, index)
+            self.applied += 1
+            self.entries += len(entry['entries']) if entry['op'] == 'batch' else 1
+            if self.entries >= self.compact_every and self.compacting is None:
+                if self.failed_snapshot is not None:
+                    self._retry_compaction()
+                elif not os.path.exists(self.old_log_path):
+                    self._start_compaction(videos)
+
+    def _discard_tail(self, offset):
+        # Cut off a partially written line; replay would otherwise stop at
+        # it and drop every entry appended after it
+        try:
+            self.log.close()
+        except OSError:
+            pass
+        try:
+            with open(self.log_path, 'r+b') as f:
+                f.truncate(offset)
+        except OSError:
+            pass
+        self.log = open(self.log_path, 'ab')
+
+    def _start_compaction(self, videos):
+        # Rotate the log and copy the catalog while holding the lock, then
+        # write the snapshot without blocking further writes.
+        self.log.close()
+        os.replace(self.log_path, self.old_log_path)
+        self.log = open(self.log_path, 'ab')
+        self.entries = 0
+        snapshot = dict(videos)
+        self.compacting = threading.Thread(target=self._compact, args=(snapshot,), daemon=True)
+        self.compacting.start()
+
+    def _retry_compaction(self):
+        # The rotated log is still on disk, so the snapshot taken at rotation
+        # is still the right one to write; wait another compact_every entries
+        # before trying again if this attempt fails too.
+        self.entries = 0
+        snapshot, self.failed_snapshot = self.failed_snapshot, None
+        self.compacting = threading.Thread(target=self._compact, args=(snapshot,), daemon=True)
+        self.compacting.start()
+
+    def _compact(self, snapshot):
+        try:
+            write_snapshot(self.snapshot_path, snapshot)
+            os.remove(self.old_log_path)
+        except OSError:
+            # Keep the rotated log: its entries only exist in `snapshot`
+            self.failed_snapshot = snapshot
+        finally:
+            self.compacting = None
+
+    def close(self):
+        if self.compacting is not None:
+            self.compacting.join()
+        with self.lock:
+            self.log.close()
+
+
+class UploadDateIndex:
+    """(uploadDate, video_id) keys kept sorted with bisect.
+
+    Built once at startup and then updated per mutation, so range and
+    "latest N" queries never have to sort or scan the whole catalog.
+    """
+
+    def __init__(self, videos):
+        self.keys = sorted(index_key(k, v) for k, v in videos.items())
+
+    def add(self, video_id, video):
+        bisect.insort(self.keys, index_key(video_id, video))
+
+    def remove(self, video_id, video):
+        key = index_key(video_id, video)
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            del self.keys[i]
+
+    def ids(self):
+        return [video_id for _, video_id in self.keys[:]]
+
+    def range(self, start=None, end=None, after=None, limit=None, reverse=False):
+        """Return (video_ids, next_cursor) for uploadDate in [start, end]."""
+        keys = self.keys
+        lo = 0 if start is None else bisect.bisect_left(keys, (start,))
+        hi = len(keys) if end is None else bisect.bisect_left(keys, (end + 1,))
+        if after is not None:
+            if reverse:
+                hi = min(hi, bisect.bisect_left(keys, after))
+            else:
+                lo = max(lo, bisect.bisect_right(keys, after))
+        if limit is None or limit >= hi - lo:
+            page = keys[lo:hi]
+            more = False
+        elif reverse:
+            page = keys[hi - limit:hi]
+            more = True
+        else:
+            page = keys[lo:lo + limit]
+            more = True
+        if reverse:
+            page = page[::-1]
+        next_cursor = encode_cursor(page[-1]) if more and page else None
+        return [video_id for _, video_id in page], next_cursor
+
+
+class IdAllocator:
+    """Hands out videoN ids from blocks reserved in persistent storage.
+
+    `reserve(count)` atomically bumps a stored counter and returns the first
+    number of the block, so worker processes sharing the storage never hand
+    out the same id and nothing ever rescans the catalog.
+    """
+
+    def __init__(self, reserve, block_size=ID_BLOCK_SIZE):
+        self.reserve = reserve
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.block_end = 0
+
+    def allocate(self, taken=lambda video_id: False):
+        with self.lock:
+            while True:
+                if self.next_id >= self.block_end:
+                    self.next_id = self.reserve(self.block_size)
+                    self.block_end = self.next_id + self.block_size
+                video_id = f"video{self.next_id}"
+                self.next_id += 1
+                if not taken(video_id):
+                    return video_id
+
+    def allocate_many(self, count, taken=lambda video_id: False):
+        video_ids = []
+        while len(video_ids) < count:
+            missing = count - len(video_ids)
+            first = self.reserve(missing)
+            video_ids += [f"video{n}" for n in range(first, first + missing) if not taken(f"video{n}")]
+        return video_ids
+
+
+def reserve_ids_in_file(path, count, seed):
+    # The file only stores the next unreserved number, so a reservation is
+    # one locked read-modify-write whatever the catalog size
+    fd = os.open(path, os.O_RDWR | os.O_CREAT)
+    with os.fdopen(fd, 'r+') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        content = f.read()
+        first = json.loads(content)['next'] if content else seed()
+        f.seek(0)
+        f.truncate()
+        json.dump({'next': first + count}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    return first
+
+def first_free_id(videos):
+    # Only used to seed the counter file the first time
+    numbers = [int(v[len('video'):]) for v in videos if v.startswith('video') and v[len('video'):].isdigit()]
+    return max(numbers, default=0) + 1
+
+def parse_video(data):
+    """Validate a dict with the same rules as `parser`."""
+    if not isinstance(data, dict):
+        abort(400, message="Each video must be an object")
+    new_video = {}
+    for arg in parser.args:
+        value = data.get(arg.name)
+        if value is None:
+            if arg.required:
+                abort(400, message={arg.name: "Missing required parameter"})
+        else:
+            try:
+                value = arg.type(value)
+            except (TypeError, ValueError):
+                abort(400, message={arg.name: f"Invalid value: {value}"})
+        new_video[arg.name] = value
+    return new_video
+
+def parse_operation(data):
+    """Turn one /videos/batch operation into a log entry."""
+    if not isinstance(data, dict) or not isinstance(data.get('id'), str) or not data['id']:
+        abort(400, message="Each operation needs an 'id'")
+    if data.get('op') == 'upsert':
+        return {'op': 'put', 'id': data['id'], 'video': parse_video(data)}
+    if data.get('op') == 'delete':
+        return {'op': 'delete', 'id': data['id']}
+    abort(400, message=f"Unknown operation {data.get('op')}, expected 'upsert' or 'delete'")
+
+def index_key(video_id, video):
+    return (video.get('uploadDate') or 0, video_id)
+
+def encode_cursor(key):
+    return f"{key[0]}:{key[1]}"
+
+def decode_cursor(cursor):
+    upload_date, _, video_id = cursor.partition(':')
+    try:
+        return (int(upload_date), video_id)
+    except ValueError:
+        abort(400, message=f"Invalid cursor {cursor}")
+
+def apply_entry(videos, entry, index=None):
+    if entry['op'] == 'batch':
+        for batch_entry in entry['entries']:
+            apply_entry(videos, batch_entry, index)
+        return
+    if index is not None and entry['id'] in videos:
+        index.remove(entry['id'], videos[entry['id']])
+    if entry['op'] == 'put':
+        videos[entry['id']] = entry['video']
+        if index is not None:
+            index.add(entry['id'], entry['video'])
+    elif entry['op'] == 'delete':
+        videos.pop(entry['id'], None)
+
+def write_snapshot(path, snapshot):
+    snapshot = { k: v for k, v in sorted(snapshot.items(),key=lambda video: video[1]["uploadDate"] or 0)}
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(snapshot, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class VideoStore:
+    """Storage backend behind the resources.
+
+    Backends implement get/all/page/iter_items/put/delete, apply_batch,
+    reserve_ids and version,
+    which must change on every mutation; id allocation on top of
+    reserve_ids is shared here.
+    """
+
+    def __init__(self):
+        self.ids = IdAllocator(self.reserve_ids)
+
+    def exists(self, video_id):
+        return self.get(video_id) is not None
+
+    def create(self, video):
+        video_id = self.ids.allocate(self.exists)
+        self.put(video_id, video)
+        return video_id
+
+    def create_many(self, new_videos):
+        if not new_videos:
+            return {}
+        video_ids = self.ids.allocate_many(len(new_videos), self.exists)
+        self.apply_batch([{'op': 'put', 'id': video_id, 'video': video}
+                          for video_id, video in zip(video_ids, new_videos)])
+        return dict(zip(video_ids, new_videos))
+
+
+class JsonStore(VideoStore):
+    """In-memory catalog persisted as videos.json plus the mutation log.
 
-def write_changes_to_file():
-    global videos
-    videos = { k: v for k, v in sorted(videos.items(),key=lambda video: video[1]["uploadDate"])}
-    with open("videos.json", 'w') as f:
-        json.dump(videos, f)
-#write_changes_to_file()
+    Fast and dependency free, but every process has its own copy, so use
+    it with a single worker only.
+    """
+
+    def __init__(self, snapshot_path, log_path, id_path):
+        self.boot_id = uuid.uuid4().hex[:8]
+        self.log = VideoLog(snapshot_path, log_path)
+        self.videos = self.log.load()
+        self.index = UploadDateIndex(self.videos)
+        self.id_path = id_path
+        super().__init__()
+
+    def version(self):
+        # The counter restarts with the process, so tag it with a boot id
+        return f"{self.boot_id}-{self.log.applied}"
+
+    def get(self, video_id):
+        return self.videos.get(video_id)
+
+    def all(self):
+        return {video_id: self.videos[video_id] for video_id in self.index.ids() if video_id in self.videos}
+
+    def iter_items(self):
+        for video_id in self.index.ids():
+            video = self.videos.get(video_id)
+            if video is not None:
+                yield video_id, video
+
+    def page(self, start=None, end=None, after=None, limit=None, reverse=False):
+        video_ids, next_cursor = self.index.range(start, end, after, limit, reverse)
+        return {video_id: self.videos[video_id] for video_id in video_ids if video_id in self.videos}, next_cursor
+
+    def put(self, video_id, video):
+        self.log.append({'op': 'put', 'id': video_id, 'video': video}, self.videos, self.index)
+
+    def delete(self, video_id):
+        if video_id not in self.videos:
+            return False
+        self.log.append({'op': 'delete', 'id': video_id}, self.videos, self.index)
+        return True
+
+    def apply_batch(self, entries):
+        # Nothing changes, so keep the version (and every client's ETag)
+        if not entries:
+            return
+        self.log.append({'op': 'batch', 'entries': entries}, self.videos, self.index)
+
+    def reserve_ids(self, count):
+        return reserve_ids_in_file(self.id_path, count, lambda: first_free_id(self.videos))
+
+
+class SQLiteStore(VideoStore):
+    """Catalog in a SQLite database in WAL mode.
+
+    Every worker process opens the same file, so they all see each other's
+    writes; WAL lets readers proceed while one writer commits.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        db = self.connection()
+        db.execute("CREATE TABLE IF NOT EXISTS videos ("
+                   "id TEXT PRIMARY KEY, title TEXT NOT NULL, uploadDate INTEGER)")
+        db.execute("CREATE INDEX IF NOT EXISTS videos_upload_date "
+                   "ON videos (COALESCE(uploadDate, 0), id)")
+        db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0)")
+        super().__init__()
+
+    def connection(self):
+        # sqlite3 connections can't be shared across threads
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            self.local.db = db
+        return db
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front so concurrent
+        # writers queue on the busy timeout instead of failing mid-transaction
+        db = self.connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def version(self):
+        return str(self.connection().execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0])
+
+    def bump_version(self, db):
+        db.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+
+    def get(self, video_id):
+        row = self.connection().execute(
+            "SELECT title, uploadDate FROM videos WHERE id = ?", (video_id,)).fetchone()
+        return None if row is None else {'title': row[0], 'uploadDate': row[1]}
+
+    def all(self):
+        return self.page()[0]
+
+    def iter_items(self):
+        # Rows are fetched from the cursor as we go, never all at once
+        rows = self.connection().execute(
+            "SELECT id, title, uploadDate FROM videos ORDER BY COALESCE(uploadDate, 0), id")
+        for row in rows:
+            yield row[0], {'title': row[1], 'uploadDate': row[2]}
+
+    def page(self, start=None, end=None, after=None, limit=None, reverse=False):
+        clauses, params = [], []
+        if start is not None:
+            clauses.append("COALESCE(uploadDate, 0) >= ?")
+            params.append(start)
+        if end is not None:
+            clauses.append("COALESCE(uploadDate, 0) <= ?")
+            params.append(end)
+        if after is not None:
+            clauses.append(f"(COALESCE(uploadDate, 0), id) {'<' if reverse else '>'} (?, ?)")
+            params += list(after)
+        order = "DESC" if reverse else "ASC"
+        sql = "SELECT id, title, uploadDate FROM videos"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += f" ORDER BY COALESCE(uploadDate, 0) {order}, id {order}"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit + 1)
+        rows = self.connection().execute(sql, params).fetchall()
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor((rows[-1][2] or 0, rows[-1][0]))
+        return {row[0]: {'title': row[1], 'uploadDate': row[2]} for row in rows}, next_cursor
+
+    def put(self, video_id, video):
+        with self.transaction() as db:
+            db.execute("INSERT OR REPLACE INTO videos (id, title, uploadDate) VALUES (?, ?, ?)",
+                       (video_id, video['title'], video['uploadDate']))
+            self.bump_version(db)
+
+    def delete(self, video_id):
+        with self.transaction() as db:
+            deleted = db.execute("DELETE FROM videos WHERE id = ?", (video_id,)).rowcount
+            if deleted:
+                self.bump_version(db)
+        return deleted > 0
+
+    def apply_batch(self, entries):
+        if not entries:
+            return
+        with self.transaction() as db:
+            for entry in entries:
+                if entry['op'] == 'put':
+                    db.execute("INSERT OR REPLACE INTO videos (id, title, uploadDate) VALUES (?, ?, ?)",
+                               (entry['id'], entry['video']['title'], entry['video']['uploadDate']))
+                else:
+                    db.execute("DELETE FROM videos WHERE id = ?", (entry['id'],))
+            self.bump_version(db)
+
+    def reserve_ids(self, count):
+        with self.transaction() as db:
+            row = db.execute("SELECT value FROM meta WHERE key = 'next_id'").fetchone()
+            if row is None:
+                first = db.execute(
+                    "SELECT COALESCE(MAX(CAST(SUBSTR(id, 6) AS INTEGER)), 0) + 1 FROM videos "
+                    "WHERE id GLOB 'video[0-9]*' AND SUBSTR(id, 6) NOT GLOB '*[^0-9]*'").fetchone()[0]
+            else:
+                first = row[0]
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('next_id', ?)", (first + count,))
+        return first
+
+    def import_json(self, snapshot_path, log_path):
+        """One-time migration from videos.json (and its log) into the database."""
+        log = VideoLog(snapshot_path, log_path)
+        videos = log.load()
+        log.close()
+        with self.transaction() as db:
+            db.executemany("INSERT OR REPLACE INTO videos (id, title, uploadDate) VALUES (?, ?, ?)",
+                           ((k, v['title'], v.get('uploadDate')) for k, v in videos.items()))
+            self.bump_version(db)
+        return len(videos)
+
+
+def open_store():
+    if STORE_BACKEND == "sqlite":
+        return SQLiteStore(DB_FILE)
+    return JsonStore(VIDEOS_FILE, LOG_FILE, ID_FILE)
+
+store = open_store()
+
+
+class CatalogCache:
+    """Full /videos body, JSON-encoded (and gzipped on demand) once per store version."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.body = None
+        self.gzipped = None
+
+    def get(self, version, compress):
+        with self.lock:
+            if self.version != version:
+                catalog = store.all()
+                body = (json.dumps(catalog) + "\n").encode()
+                if store.version() != version:
+                    # Changed while we were reading it; serve it but don't cache it
+                    return gzip.compress(body) if compress else body
+                self.version, self.body, self.gzipped = version, body, None
+            if compress and self.gzipped is None:
+                self.gzipped = gzip.compress(self.body)
+            return self.gzipped if compress else self.body
+
+catalog_cache = CatalogCache()
+
+def export_ndjson():
+    lines = []
+    for video_id, video in store.iter_items():
+        lines.append(json.dumps({'id': video_id, **video}))
+        if len(lines) >= EXPORT_CHUNK_LINES:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+def import_ndjson(lines):
+    """Upsert one {"id": ..., "title": ..., "uploadDate": ...} object per line.
+
+    Lines are applied in batches of IMPORT_CHUNK_SIZE as they are read, so
+    memory stays flat; a bad line stops the import after the batches
+    already applied.
+    """
+    entries = []
+    count = 0
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError:
+            abort(400, message=f"Line {number} is not valid JSON ({count} videos imported)")
+        if not isinstance(data, dict):
+            abort(400, message=f"Line {number} is not an object ({count} videos imported)")
+        entries.append(parse_operation({**data, 'op': 'upsert'}))
+        if len(entries) >= IMPORT_CHUNK_SIZE:
+            store.apply_batch(entries)
+            count += len(entries)
+            entries = []
+    if entries:
+        store.apply_batch(entries)
+        count += len(entries)
+    return count
+
+def not_modified(tag):
+    # werkzeug parses If-None-Match into unquoted tags
+    if request.if_none_match.contains_weak(tag):
+        return Response(status=304, headers={'ETag': quote_etag(tag)})
+    return None
 
 
 
@@ -34,29 +651,50 @@ class Index(Resource):
 
 class AllVideos(Resource):
     def get(self):
-        return videos, 200
+        version = store.version()
+        if not request.args:
+            compress = request.accept_encodings['gzip'] > 0
+            # The gzip body has different bytes, so it gets its own strong tag
+            tag = f"{version}-gz" if compress else version
+            cached = not_modified(tag)
+            if cached is not None:
+                cached.headers['Vary'] = 'Accept-Encoding'
+                return cached
+            response = Response(catalog_cache.get(version, compress), mimetype='application/json',
+                                headers={'ETag': quote_etag(tag), 'Vary': 'Accept-Encoding'})
+            if compress:
+                response.headers['Content-Encoding'] = 'gzip'
+            return response
+        tag = f"{version}-{zlib.crc32(request.query_string):x}"
+        cached = not_modified(tag)
+        if cached is not None:
+            return cached
+        args = query_parser.parse_args()
+        if args['limit'] is not None and args['limit'] < 1:
+            abort(400, message="limit must be a positive integer")
+        after = decode_cursor(args['cursor']) if args['cursor'] else None
+        page, next_cursor = store.page(args['from'], args['to'], after,
+                                       args['limit'], args['order'] == 'desc')
+        return {'videos': page, 'next': next_cursor}, 200, {'ETag': quote_etag(tag)}
 
 class IdVideo(Resource):
     def get(self,video_id):
-        allIds = videos.keys()
-        if(not video_id in allIds):
+        video = store.get(video_id)
+        if(video is None):
             abort(404, message =f"Video {video_id} not found!")
         else:
-            return videos[video_id],200
+            return video,200
 
     def put(self, video_id):
         args = parser.parse_args()
         new_video = {'title':args['title'],
                      'uploadDate':args['uploadDate']}
-        videos[video_id] = new_video
-        write_changes_to_file()
-        return {video_id: videos[video_id]}, 201
+        store.put(video_id, new_video)
+        return {video_id: new_video}, 201
 
     def delete(self,video_id):
-        if video_id not in videos:
+        if not store.delete(video_id):
             abort(404, message =f"Video {video_id} not found!")
-        del videos[video_id]
-        write_changes_to_file()
         return "", 204
 
 class VideoSchedule(Resource):
@@ -64,16 +702,54 @@ class VideoSchedule(Resource):
         args = parser.parse_args()
         new_video = {'title':args['title'],
                      'uploadDate':args['uploadDate']}
-        video_id = max(int(v.lstrip('video')) for v in videos.keys()) + 1
-        video_id = f"video{video_id}"
-        videos[video_id] = new_video
-        write_changes_to_file()
-        return videos[video_id], 201
+        store.create(new_video)
+        return new_video, 201
+
+class BulkVideos(Resource):
+    def post(self):
+        items = request.get_json(silent=True)
+        if not isinstance(items, list):
+            abort(400, message="Expected a JSON list of videos")
+        new_videos = [parse_video(item) for item in items]
+        return store.create_many(new_videos), 201
+
+class BatchVideos(Resource):
+    def post(self):
+        operations = request.get_json(silent=True)
+        if not isinstance(operations, list):
+            abort(400, message="Expected a JSON list of operations")
+        # Validate everything before touching the store so a bad operation
+        # rejects the whole batch
+        entries = [parse_operation(operation) for operation in operations]
+        store.apply_batch(entries)
+        return {'applied': len(entries)}, 200
+
+class ExportVideos(Resource):
+    def get(self):
+        return Response(stream_with_context(export_ndjson()), mimetype='application/x-ndjson')
+
+class ImportVideos(Resource):
+    def post(self):
+        return {'imported': import_ndjson(request.stream)}, 200
 
 api.add_resource(Index, "/")
 api.add_resource(AllVideos,"/videos")
 api.add_resource(VideoSchedule,"/videos")
+api.add_resource(BulkVideos,"/videos/bulk")
+api.add_resource(BatchVideos,"/videos/batch")
+api.add_resource(ExportVideos,"/videos/export")
+api.add_resource(ImportVideos,"/videos/import")
 api.add_resource(IdVideo,"/video/<video_id>")
 
 if __name__ == "__main__":
-    app.run()
\ No newline at end of file
+    if sys.argv[1:] == ["migrate"]:
+        count = SQLiteStore(DB_FILE).import_json(VIDEOS_FILE, LOG_FILE)
+        print(f"Imported {count} videos into {DB_FILE}")
+    elif sys.argv[1:2] == ["import"] and len(sys.argv) == 3:
+        with open(sys.argv[2], 'rb') as f:
+            print(f"Imported {import_ndjson(f)} videos")
+    elif sys.argv[1:2] == ["export"] and len(sys.argv) == 3:
+        with open(sys.argv[2], 'w') as f:
+            f.writelines(export_ndjson())
+    else:
+        app.run()
\ No newline at end of file
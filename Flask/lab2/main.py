@@ -1,13 +1,33 @@
-from flask import Flask, render_template
+from flask import Flask, render_template, request, jsonify, send_file, abort
 from flask_wtf import FlaskForm
 from wtforms import FileField, SubmitField
 from wtforms.validators import InputRequired
 from werkzeug.utils import secure_filename
+import hashlib
+import json
 import os
+import re
+import secrets
+import threading
+import uuid
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'supersecretkey'
 app.config['UPLOAD_FOLDER'] = 'static/files'
+# The content store stays outside static/: objects are named by their hash
+# and the index maps names to hashes, so serving either would let anyone skip
+# the proof of possession
+app.config['PARTIAL_FOLDER'] = os.path.join(app.instance_path, 'partial')
+app.config['OBJECT_FOLDER'] = os.path.join(app.instance_path, 'objects')
+app.config['INDEX_FILE'] = os.path.join(app.instance_path, 'index.json')
+# Let nginx/Apache send the bytes with X-Sendfile instead of the worker
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+CHUNK_SIZE = 64 * 1024
+PROOF_SIZE = 64 * 1024
+LEGACY_EXCLUDED = {'index.json', 'index.json.tmp'}
+CONTENT_RANGE = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
 
 class UploadFileForm(FlaskForm):
     file = FileField('File', validators=[InputRequired()])
@@ -21,17 +41,261 @@ def home():
     form = UploadFileForm()
     if form.validate_on_submit():
         file = form.file.data
-        file.save(
-            os.path.join(
-                os.path.abspath(
-                    os.path.dirname(__file__)
-                ),
-                app.config['UPLOAD_FOLDER'],
-                secure_filename(file.filename)
-            )
-        )
+        name, digest, stored = store_upload(file.stream, secure_filename(file.filename))
+        if not stored:
+            return f"File has been uploaded (same content as an existing file, saved as {name})"
         return "File has been uploaded"
     return render_template('index.html', form=form)
 
+# Uploads are stored once per content under objects/<sha256>; index.json
+# maps every uploaded filename to the hash of its content. Same-named files
+# with different content get the hash appended instead of overwriting.
+index_lock = threading.Lock()
+
+def object_path(digest):
+    return os.path.join(app.config['OBJECT_FOLDER'], digest)
+
+def migrate_store():
+    """Move a content store left under static/files by older versions out of the public folder."""
+    legacy = os.path.join(BASE_DIR, app.config['UPLOAD_FOLDER'])
+    os.makedirs(app.instance_path, exist_ok=True)
+    for old, new in ((os.path.join(legacy, 'index.json'), app.config['INDEX_FILE']),
+                     (os.path.join(legacy, 'objects'), app.config['OBJECT_FOLDER']),
+                     (os.path.join(legacy, '.partial'), app.config['PARTIAL_FOLDER'])):
+        if os.path.exists(old) and not os.path.exists(new):
+            os.replace(old, new)
+
+def load_index():
+    path = app.config['INDEX_FILE']
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+migrate_store()
+file_index = load_index()
+
+def add_to_index(filename, digest):
+    with index_lock:
+        name = filename
+        if file_index.get(name, digest) != digest:
+            stem, ext = os.path.splitext(filename)
+            name = f"{stem}-{digest[:12]}{ext}"
+        if file_index.get(name) != digest:
+            file_index[name] = digest
+            path = app.config['INDEX_FILE']
+            with open(path + '.tmp', 'w') as f:
+                json.dump(file_index, f)
+            os.replace(path + '.tmp', path)
+    return name
+
+def commit_object(tmp_path, digest, filename):
+    """Move a fully written temp file into the store, unless its content is already there."""
+    os.makedirs(app.config['OBJECT_FOLDER'], exist_ok=True)
+    stored = not os.path.exists(object_path(digest))
+    if stored:
+        os.replace(tmp_path, object_path(digest))
+    else:
+        os.remove(tmp_path)
+    return add_to_index(filename, digest), digest, stored
+
+def hash_stream(stream):
+    hasher = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+        hasher.update(chunk)
+    return hasher
+
+def store_upload(stream, filename):
+    # Werkzeug has already spooled the form upload, so hash it first and
+    # only copy the bytes when the content is new
+    digest = hash_stream(stream).hexdigest()
+    if os.path.exists(object_path(digest)):
+        return add_to_index(filename, digest), digest, False
+    stream.seek(0)
+    os.makedirs(app.config['PARTIAL_FOLDER'], exist_ok=True)
+    tmp_path = partial_path(uuid.uuid4().hex, 'tmp')
+    with open(tmp_path, 'wb') as f:
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+            f.write(chunk)
+    return commit_object(tmp_path, digest, filename)
+
+# Chunked uploads: POST /uploads opens a session, PUT /uploads/<id> appends
+# a byte range streamed straight to disk, GET /uploads/<id> tells a client
+# where to resume and POST /uploads/<id>/finalize moves the file into place.
+# The partial file itself is the source of truth for the offset, so sessions
+# survive a dropped connection or a server restart. Chunks are hashed as they
+# stream in; after a restart the hash is rebuilt from the partial file.
+upload_locks = {}
+upload_hashers = {}
+upload_locks_guard = threading.Lock()
+
+def partial_path(upload_id, ext):
+    return os.path.join(app.config['PARTIAL_FOLDER'], f"{upload_id}.{ext}")
+
+def load_session(upload_id):
+    if not re.fullmatch(r'[0-9a-f]{32}', upload_id) or not os.path.exists(partial_path(upload_id, 'json')):
+        return None
+    with open(partial_path(upload_id, 'json')) as f:
+        session = json.load(f)
+    session['offset'] = os.path.getsize(partial_path(upload_id, 'part'))
+    return session
+
+def session_hasher(upload_id, offset):
+    hasher, hashed = upload_hashers.get(upload_id, (None, -1))
+    if hashed != offset:
+        with open(partial_path(upload_id, 'part'), 'rb') as f:
+            hasher = hash_stream(f)
+    return hasher
+
+def session_lock(upload_id):
+    with upload_locks_guard:
+        return upload_locks.setdefault(upload_id, threading.Lock())
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(data.get('filename', ''))
+    size = data.get('size')
+    if not filename or not isinstance(size, int) or size < 0:
+        return jsonify({'error': 'filename and size are required'}), 400
+    upload_id = uuid.uuid4().hex
+    session = {'filename': filename, 'size': size}
+    # A client that claims content we already have can skip the upload, but
+    # only by proving it has the bytes: knowing a hash alone must not give
+    # access to someone else's file. It gets a random range and a nonce and
+    # answers with sha256(nonce + bytes of that range) on /prove.
+    digest = data.get('sha256')
+    challenge = None
+    if (isinstance(digest, str) and re.fullmatch(r'[0-9a-f]{64}', digest) and size > 0
+            and os.path.exists(object_path(digest)) and os.path.getsize(object_path(digest)) == size):
+        length = min(size, PROOF_SIZE)
+        challenge = {'offset': secrets.randbelow(size - length + 1), 'length': length,
+                     'nonce': secrets.token_hex(16)}
+        session['claim'] = dict(challenge, sha256=digest)
+    os.makedirs(app.config['PARTIAL_FOLDER'], exist_ok=True)
+    open(partial_path(upload_id, 'part'), 'wb').close()
+    with open(partial_path(upload_id, 'json'), 'w') as f:
+        json.dump(session, f)
+    body = {'upload_id': upload_id, 'offset': 0}
+    if challenge is not None:
+        body['challenge'] = challenge
+    return jsonify(body), 201
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    session = load_session(upload_id)
+    if session is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    session.pop('claim', None)
+    return jsonify(session)
+
+def range_proof(path, claim):
+    hasher = hashlib.sha256(bytes.fromhex(claim['nonce']))
+    with open(path, 'rb') as f:
+        f.seek(claim['offset'])
+        hasher.update(f.read(claim['length']))
+    return hasher.hexdigest()
+
+@app.route('/uploads/<upload_id>/prove', methods=['POST'])
+def prove_upload(upload_id):
+    """Finish an upload without sending it, by answering the dedup challenge."""
+    data = request.get_json(silent=True) or {}
+    with session_lock(upload_id):
+        session = load_session(upload_id)
+        if session is None:
+            return jsonify({'error': 'Upload not found'}), 404
+        claim = session.get('claim')
+        if claim is None:
+            return jsonify({'error': 'No challenge for this upload'}), 409
+        # One attempt per challenge, so the range can't be brute-forced
+        del session['claim']
+        session.pop('offset', None)
+        with open(partial_path(upload_id, 'json'), 'w') as f:
+            json.dump(session, f)
+        proof = data.get('proof')
+        if not isinstance(proof, str) or not secrets.compare_digest(proof, range_proof(object_path(claim['sha256']), claim)):
+            return jsonify({'error': 'Proof does not match; upload the file instead'}), 403
+        name = add_to_index(session['filename'], claim['sha256'])
+        os.remove(partial_path(upload_id, 'part'))
+        os.remove(partial_path(upload_id, 'json'))
+    with upload_locks_guard:
+        upload_locks.pop(upload_id, None)
+    return jsonify({'filename': name, 'sha256': claim['sha256'], 'size': session['size'],
+                    'deduplicated': True})
+
+@app.route('/uploads/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    session = load_session(upload_id)
+    if session is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    lock = session_lock(upload_id)
+    if not lock.acquire(blocking=False):
+        return jsonify({'error': 'Another chunk is being written', 'offset': session['offset']}), 409
+    try:
+        offset = os.path.getsize(partial_path(upload_id, 'part'))
+        start = offset
+        if 'Content-Range' in request.headers:
+            match = CONTENT_RANGE.fullmatch(request.headers['Content-Range'])
+            if match is None:
+                return jsonify({'error': 'Invalid Content-Range'}), 400
+            start = int(match.group(1))
+        # Chunks must arrive in order; tell the client where to resume
+        if start != offset:
+            return jsonify({'error': 'Unexpected offset', 'offset': offset}), 409
+        remaining = session['size'] - offset
+        hasher = session_hasher(upload_id, offset)
+        with open(partial_path(upload_id, 'part'), 'ab') as f:
+            while remaining > 0:
+                chunk = request.stream.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                f.write(chunk)
+                hasher.update(chunk)
+                remaining -= len(chunk)
+        upload_hashers[upload_id] = (hasher, session['size'] - remaining)
+        return jsonify({'offset': session['size'] - remaining, 'size': session['size']})
+    finally:
+        lock.release()
+
+@app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_upload(upload_id):
+    if load_session(upload_id) is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    with session_lock(upload_id):
+        session = load_session(upload_id)
+        if session is None:
+            return jsonify({'error': 'Upload not found'}), 404
+        if session['offset'] != session['size']:
+            return jsonify({'error': 'Upload incomplete', 'offset': session['offset']}), 409
+        digest = session_hasher(upload_id, session['offset']).hexdigest()
+        name, digest, stored = commit_object(partial_path(upload_id, 'part'), digest, session['filename'])
+        os.remove(partial_path(upload_id, 'json'))
+    with upload_locks_guard:
+        upload_locks.pop(upload_id, None)
+        upload_hashers.pop(upload_id, None)
+    return jsonify({'filename': name, 'sha256': digest, 'size': session['size'],
+                    'deduplicated': not stored})
+
+@app.route('/files/<filename>', methods=['GET'])
+def download(filename):
+    # send_file answers Range and If-Modified-Since/If-None-Match itself.
+    # A full response hands the open file to the server's wsgi.file_wrapper
+    # (sendfile under gunicorn). A Range response is read and copied in
+    # Python by werkzeug's _RangeWrapper, so deployments serving large
+    # partial downloads should run behind nginx/Apache with USE_X_SENDFILE=1,
+    # where the web server sends the bytes for both.
+    name = secure_filename(filename)
+    digest = file_index.get(name)
+    if digest is not None:
+        # Objects never change, so the hash is a strong ETag
+        return send_file(object_path(digest), download_name=name, conditional=True,
+                         etag=digest, max_age=3600)
+    # Files uploaded before the content store existed; only plain files,
+    # never a store file an older version may have left next to them
+    path = os.path.join(BASE_DIR, app.config['UPLOAD_FOLDER'], name)
+    if not name or name in LEGACY_EXCLUDED or not os.path.isfile(path):
+        abort(404)
+    return send_file(path, download_name=name, conditional=True)
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
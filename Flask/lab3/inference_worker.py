@@ -0,0 +1,30 @@
+from keras.models import load_model
+from multiprocessing import shared_memory
+import numpy as np
+
+# Runs inside the inference worker processes. Kept apart from main.py so
+# the pool can pickle these functions by reference; note that when the
+# server is started as `python main.py`, spawn still re-imports main.py in
+# each worker as __mp_main__ (main.py skips its startup work in workers).
+model = None
+
+def init_worker(path, image_shape):
+    global model
+    model = load_model(path)
+    model.make_predict_function()
+    model.predict(np.zeros((1,) + image_shape, dtype=np.float32))
+
+def ping():
+    """Answered once the initializer has loaded and warmed up the model."""
+    return model is not None
+
+def predict(name, shape, dtype):
+    """Predict on a batch the server left in the shared memory block `name`."""
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        batch = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        predictions = model.predict(batch)
+        del batch
+    finally:
+        block.close()
+    return predictions
\ No newline at end of file
@@ -1,27 +1,442 @@
-from flask import Flask, render_template, request
+from flask import Flask, render_template, request, jsonify
 from keras.models import load_model
-from keras.preprocessing import image
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+import inference_worker
+from PIL import Image
+from werkzeug.utils import secure_filename
+import base64
+import hashlib
+import io
+import multiprocessing
+import numpy as np
+import os
+import queue
+import threading
+import time
+import zipfile
 
 app = Flask(__name__)
 dic = {0 : 'Cat', 1 : 'Dog'}
 
-model = load_model('model.h5')
+MAX_BATCH_SIZE = int(os.environ.get('PREDICT_MAX_BATCH', 32))
+MAX_WAIT_MS = float(os.environ.get('PREDICT_MAX_WAIT_MS', 5))
+SAVE_UPLOADS = os.environ.get('SAVE_UPLOADS', '1') == '1'
+IMAGE_SIZE = (100, 100)
+CACHE_SIZE = int(os.environ.get('PREDICTION_CACHE_SIZE', 1024))
+CACHE_TTL = float(os.environ.get('PREDICTION_CACHE_TTL', 3600))
+MODEL_PATH = 'model.h5'
+MAX_REQUEST_IMAGES = int(os.environ.get('PREDICT_BATCH_LIMIT', 512))
+MAX_IMAGE_BYTES = int(os.environ.get('PREDICT_MAX_IMAGE_BYTES', 10 * 1024 * 1024))
+MAX_REQUEST_BYTES = int(os.environ.get('PREDICT_MAX_REQUEST_BYTES', 200 * 1024 * 1024))
+MAX_IMAGE_PIXELS = int(os.environ.get('PREDICT_MAX_IMAGE_PIXELS', 20_000_000))
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp')
+MODEL_LAZY = os.environ.get('MODEL_LAZY') == '1'
+MODEL_POLL_SECONDS = float(os.environ.get('MODEL_POLL_SECONDS', 5))
+MODEL_WAIT_SECONDS = float(os.environ.get('MODEL_WAIT_SECONDS', 30))
+INFERENCE_WORKERS = int(os.environ.get('INFERENCE_WORKERS', 0))
 
-model.make_predict_function()
-def predict_label(img_path):
-    i = image.load_img(img_path, target_size=(100,100))
-    i = image.img_to_array(i)/255.0
-    i = i.reshape(1, 100,100,3)
+class ModelNotReady(Exception):
+    pass
 
-    p = model.predict(i)
-    prediction_value = p[0][0]
+class RequestTooLarge(Exception):
+    pass
 
+class ModelHolder:
+    """Owns the current model: loading, warmup and hot reload.
+
+    The model loads on a background thread (or on first use with
+    MODEL_LAZY=1) and runs one warmup predict before it is marked ready.
+    Afterwards the file's mtime is polled; a changed model.h5 is loaded
+    and warmed up on the side and then swapped in with a single
+    assignment. Requests already holding the old model finish with it.
+    """
+
+    def __init__(self, path, poll_seconds=MODEL_POLL_SECONDS):
+        self.path = path
+        self.poll_seconds = poll_seconds
+        self.current = None
+        self.ready = threading.Event()
+        self.load_lock = threading.Lock()
+        self.error = None
+        self.failed_version = None
+        self.lazy = False
+
+    def start(self, lazy=False):
+        self.lazy = lazy
+        threading.Thread(target=self.run, args=(lazy,), daemon=True).start()
+
+    def run(self, lazy):
+        if not lazy:
+            self.reload()
+        while self.poll_seconds > 0:
+            time.sleep(self.poll_seconds)
+            version = self.file_version()
+            if self.current is None and lazy:
+                continue
+            if version not in (self.failed_version, self.current and self.current[1]):
+                self.reload()
+
+    def file_version(self):
+        try:
+            return os.path.getmtime(self.path)
+        except OSError:
+            return None
+
+    def reload(self):
+        with self.load_lock:
+            version = self.file_version()
+            if self.current is not None and self.current[1] == version:
+                return
+            try:
+                model = self.load()
+            except Exception as e:
+                # Keep serving the previous model if the new file is broken
+                self.error = str(e)
+                self.failed_version = version
+                print(f"Could not load {self.path}: {e}")
+                return
+            self.swap(model, version)
+            self.error = None
+            self.ready.set()
+            print(f"Loaded {self.path} (version {version})")
+
+    def load(self):
+        model = load_model(self.path)
+        model.make_predict_function()
+        model.predict(np.zeros((1,) + IMAGE_SIZE + (3,), dtype=np.float32))
+        return model
+
+    def swap(self, model, version):
+        self.current = (model, version)
+
+    def predict(self, batch):
+        return self.get()[0].predict(batch)
+
+    def get(self, timeout=MODEL_WAIT_SECONDS):
+        """Return (model, version), loading it first if it is lazy."""
+        if self.current is None and not self.ready.is_set() and self.lazy:
+            self.reload()
+        if not self.ready.wait(timeout):
+            raise ModelNotReady(self.error or "Model is still loading")
+        return self.current
+
+    def version(self):
+        return self.get()[1]
+
+    def load_in_background(self):
+        """Start a lazy load without waiting for it, unless one is already running.
+
+        A file that already failed to load is not retried until it changes.
+        """
+        if (self.lazy and not self.ready.is_set() and not self.load_lock.locked()
+                and self.file_version() != self.failed_version):
+            threading.Thread(target=self.reload, daemon=True).start()
+
+class ProcessModelHolder(ModelHolder):
+    """ModelHolder whose "model" is a pool of worker processes (INFERENCE_WORKERS > 0).
+
+    Only the workers load the model; the server process just watches the
+    file's mtime. A new version gets a fresh pool, which counts as loaded
+    once a worker has run its initializer (load + warmup) and answered a
+    probe. Batches travel through shared memory and only the small
+    prediction array is pickled back. Batches already submitted to the
+    old pool finish there.
+    """
+
+    def __init__(self, path, workers, poll_seconds=MODEL_POLL_SECONDS):
+        super().__init__(path, poll_seconds)
+        self.workers = workers
+        # Held while submitting, so a reload can't shut the pool down in between
+        self.pool_lock = threading.Lock()
+
+    def load(self):
+        # TensorFlow doesn't survive fork, so workers are spawned
+        pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=inference_worker.init_worker,
+                                   initargs=(self.path, IMAGE_SIZE + (3,)))
+        try:
+            pool.submit(inference_worker.ping).result()
+        except Exception:
+            pool.shutdown(wait=False)
+            raise
+        return pool
+
+    def swap(self, pool, version):
+        with self.pool_lock:
+            old = self.current
+            self.current = (pool, version)
+        if old is not None:
+            old[0].shutdown(wait=False)
+
+    def predict(self, batch):
+        self.get()
+        batch = np.ascontiguousarray(batch, dtype=np.float32)
+        block = shared_memory.SharedMemory(create=True, size=batch.nbytes)
+        try:
+            np.ndarray(batch.shape, dtype=batch.dtype, buffer=block.buf)[:] = batch
+            with self.pool_lock:
+                future = self.current[0].submit(inference_worker.predict, block.name, batch.shape,
+                                                batch.dtype.str)
+            return future.result()
+        finally:
+            block.close()
+            block.unlink()
+
+if INFERENCE_WORKERS > 0:
+    model_holder = ProcessModelHolder(MODEL_PATH, INFERENCE_WORKERS)
+else:
+    model_holder = ModelHolder(MODEL_PATH)
+
+def run_model(batch):
+    return model_holder.predict(batch)
+
+class PredictionBatcher:
+    """Groups concurrent predictions into one model.predict call.
+
+    Requests queue up their image; a worker thread takes the first one,
+    waits up to max_wait_ms for more (or until max_batch_size), runs the
+    stacked batch through the model and hands each caller its own result.
+    One big predict is much cheaper than many small ones. With several
+    worker threads, batches are formed and run concurrently (one per
+    inference process).
+    """
+
+    def __init__(self, predict, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS, threads=1):
+        self.predict_batch = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.requests = queue.Queue()
+        self.workers = [threading.Thread(target=self.run, daemon=True) for _ in range(threads)]
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def predict(self, tensor):
+        """Predict a single (100,100,3) image, blocking until its batch has run."""
+        future = Future()
+        self.requests.put((tensor, future))
+        return future.result()
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            tensors, futures = zip(*batch)
+            try:
+                predictions = self.predict_batch(np.stack(tensors))
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            for future, prediction in zip(futures, predictions):
+                future.set_result(prediction)
+
+batcher = PredictionBatcher(run_model, threads=max(1, INFERENCE_WORKERS))
+
+# Each request thread decodes into its own preallocated buffer; the batcher
+# copies it into the batch before predict returns, so it can be reused
+buffers = threading.local()
+# Uploads are kept on disk (SAVE_UPLOADS) off the request path
+saver = ThreadPoolExecutor(max_workers=1)
+
+# Spawned inference workers re-import the server's main script (this file
+# as __mp_main__ with `python main.py`). Building the app and these objects
+# there is cheap (the executor starts no thread until used); loading the
+# model and starting the batcher threads is not, so only the server process
+# does that. Spawn renames the child process before importing anything.
+if multiprocessing.current_process().name == 'MainProcess':
+    model_holder.start(lazy=MODEL_LAZY)
+    batcher.start()
+
+def load_tensor(data, out=None):
+    """Decode image bytes into a normalized (100,100,3) float32 array.
+
+    Same steps as keras' load_img/img_to_array (RGB, nearest-neighbour
+    resize, /255) but straight from memory. Images over MAX_IMAGE_PIXELS
+    raise ValueError before any pixel data is decoded: a few KB of PNG can
+    describe a picture that takes gigabytes once decompressed.
+    """
+    if out is None:
+        out = getattr(buffers, 'image', None)
+        if out is None:
+            out = buffers.image = np.empty(IMAGE_SIZE + (3,), dtype=np.float32)
+    try:
+        img = Image.open(io.BytesIO(data))
+    except Image.DecompressionBombError as e:
+        raise ValueError(str(e)) from e
+    with img:
+        # Opening only reads the header, so the size is known before decoding
+        if img.width * img.height > MAX_IMAGE_PIXELS:
+            raise ValueError(f"{img.width}x{img.height} is more than {MAX_IMAGE_PIXELS} pixels")
+        img = img.convert('RGB').resize(IMAGE_SIZE, Image.NEAREST)
+        np.divide(np.asarray(img), 255.0, out=out)
+    return out
+
+class PredictionCache:
+    """LRU cache of prediction values with a TTL, keyed by image hash.
+
+    Entries belong to one model version; asking with a different version
+    drops everything, so a new model never serves stale predictions.
+    """
+
+    def __init__(self, max_size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+            entry = self.entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, version, value):
+        with self.lock:
+            if version != self.version:
+                return
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'max_size': self.max_size, 'ttl': self.ttl,
+                    'hits': self.hits, 'misses': self.misses, 'model_version': self.version}
+
+prediction_cache = PredictionCache()
+
+def save_upload(data, img_path):
+    with open(img_path, 'wb') as f:
+        f.write(data)
+
+def predict_value(data):
+    """Prediction for raw image bytes, from the cache if we've seen them before."""
+    key = hashlib.sha256(data).hexdigest()
+    version = model_holder.version()
+    prediction_value = prediction_cache.get(key, version)
+    if prediction_value is None:
+        prediction_value = float(batcher.predict(load_tensor(data))[0])
+        # Only cache it if the model wasn't swapped while we predicted
+        if model_holder.version() == version:
+            prediction_cache.put(key, version, prediction_value)
+    return prediction_value
+
+def label_for(prediction_value):
     if prediction_value > 0.85 :
         return dic[1]
     elif prediction_value < 0.15:
         return dic[0]
     else:
-        return prediction_value
+        return None
+
+def predict_label(data):
+    prediction_value = predict_value(data)
+    label = label_for(prediction_value)
+    return prediction_value if label is None else label
+
+def predict_many(images):
+    """Predict a list of (name, bytes) with a single model.predict call.
+
+    Cached images are answered from the cache; the rest are decoded into
+    one preallocated batch array.
+    """
+    version = model_holder.version()
+    keys = [hashlib.sha256(data).hexdigest() for _, data in images]
+    values = [prediction_cache.get(key, version) for key in keys]
+    pending = [k for k, value in enumerate(values) if value is None]
+    errors = {}
+    if pending:
+        batch = np.empty((len(pending),) + IMAGE_SIZE + (3,), dtype=np.float32)
+        decoded = []
+        for k in pending:
+            try:
+                load_tensor(images[k][1], out=batch[len(decoded)])
+                decoded.append(k)
+            except (OSError, ValueError) as e:
+                errors[k] = f"Could not read image: {e}"
+        if decoded:
+            predictions = run_model(batch[:len(decoded)])
+            for k, prediction in zip(decoded, predictions):
+                values[k] = float(prediction[0])
+                prediction_cache.put(keys[k], version, values[k])
+    results = []
+    for k, (name, _) in enumerate(images):
+        if k in errors:
+            results.append({'filename': name, 'error': errors[k]})
+        else:
+            results.append({'filename': name, 'label': label_for(values[k]),
+                            'prediction_value': values[k]})
+    return results
+
+def is_image_member(info):
+    # Skip folders, macOS resource forks and hidden files zip tools add
+    name = info.filename
+    base = os.path.basename(name)
+    return (not info.is_dir() and not name.startswith('__MACOSX/') and not base.startswith('.')
+            and base.lower().endswith(IMAGE_EXTENSIONS))
+
+def check_size(name, size, budget):
+    if size > MAX_IMAGE_BYTES:
+        raise RequestTooLarge(f"{name} is larger than {MAX_IMAGE_BYTES} bytes")
+    if size > budget:
+        raise RequestTooLarge(f"Images add up to more than {MAX_REQUEST_BYTES} bytes")
+
+def read_limited(stream, name, budget):
+    # Never trust a declared size: read one byte past the limit to notice
+    data = stream.read(min(MAX_IMAGE_BYTES, budget) + 1)
+    check_size(name, len(data), budget)
+    return data
+
+def request_images():
+    """(name, bytes) for every uploaded image, unpacking .zip archives.
+
+    Zip members are checked against the per-image and per-request byte
+    limits before they are decompressed, and again while reading, so a
+    small archive can't expand into gigabytes of memory.
+    """
+    images = []
+    budget = MAX_REQUEST_BYTES
+    for upload in request.files.getlist('images') + request.files.getlist('archive'):
+        if upload.filename.lower().endswith('.zip'):
+            with zipfile.ZipFile(upload.stream) as archive:
+                for info in archive.infolist():
+                    if not is_image_member(info) or len(images) > MAX_REQUEST_IMAGES:
+                        continue
+                    check_size(info.filename, info.file_size, budget)
+                    with archive.open(info) as member:
+                        data = read_limited(member, info.filename, budget)
+                    budget -= len(data)
+                    images.append((info.filename, data))
+        elif len(images) <= MAX_REQUEST_IMAGES:
+            data = read_limited(upload.stream, upload.filename, budget)
+            budget -= len(data)
+            images.append((upload.filename, data))
+    return images
 
 # routes
 @app.route("/", methods=['GET', 'POST'])
@@ -32,10 +447,47 @@ def main():
 def get_output():
     if request.method == 'POST':
         img = request.files['my_image']
-        img_path = "static/" + img.filename
-        img.save(img_path)
-        p = predict_label(img_path)
-    return render_template("index.html", prediction = p, img_path = img_path)
+        data = img.read()
+        if SAVE_UPLOADS:
+            saver.submit(save_upload, data, "static/" + secure_filename(img.filename))
+        p = predict_label(data)
+        # The background save may not have run yet, so show the bytes we have
+        img_src = f"data:{img.mimetype or 'image/jpeg'};base64,{base64.b64encode(data).decode()}"
+    return render_template("index.html", prediction = p, img_src = img_src)
+
+@app.route("/predict/batch", methods=['POST'])
+def predict_batch():
+    try:
+        images = request_images()
+    except zipfile.BadZipFile:
+        return jsonify({'error': 'Invalid zip archive'}), 400
+    if not images:
+        return jsonify({'error': "Send images as 'images' files or a zip as 'archive'"}), 400
+    if len(images) > MAX_REQUEST_IMAGES:
+        return jsonify({'error': f'At most {MAX_REQUEST_IMAGES} images per request'}), 413
+    return jsonify({'results': predict_many(images)})
+
+@app.route("/ready", methods=['GET'])
+def ready():
+    # A lazy model would otherwise wait for a request the load balancer
+    # never sends while /ready says 503
+    model_holder.load_in_background()
+    if not model_holder.ready.is_set():
+        return jsonify({'ready': False, 'error': model_holder.error}), 503
+    return jsonify({'ready': True, 'model_version': model_holder.current[1],
+                    'reload_error': model_holder.error})
+
+@app.errorhandler(RequestTooLarge)
+def request_too_large(e):
+    return jsonify({'error': str(e)}), 413
+
+@app.errorhandler(ModelNotReady)
+def model_not_ready(e):
+    return jsonify({'error': str(e)}), 503
+
+@app.route("/cache/stats", methods=['GET'])
+def cache_stats():
+    return jsonify(prediction_cache.stats())
 
 if __name__ =='__main__':
     #app.debug = True
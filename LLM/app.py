@@ -1,7 +1,13 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, g, request, jsonify, render_template, stream_with_context
 from flask_cors import CORS
+from collections import OrderedDict, deque
 import requests
 import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
 
 app = Flask(__name__)
 CORS(app)
@@ -51,14 +57,290 @@ PERSONALITIES = {
     }
 }
 
-# Historial de conversación (en memoria)
-conversation_history = []
+# ============ HISTORIAL DE CONVERSACIÓN ============
+HISTORY_SIZE = 50          # Mensajes que se guardan por conversación
+SESSION_IDLE_SECONDS = 3600  # Conversaciones inactivas se descartan
+MAX_SESSIONS = 1000        # Límite de conversaciones en memoria
+MAX_STORE_TOKENS = int(os.environ.get('MAX_STORE_TOKENS', 2_000_000))  # Tokens en memoria entre todas las sesiones
+CHAT_STORE = os.environ.get('CHAT_STORE', 'memory')
+CHAT_DB = os.environ.get('CHAT_DB', 'conversations.db')
+
+def estimate_tokens(text):
+    """Estimación barata de tokens (~4 caracteres por token)"""
+    return len(text) // 4 + 1
+
+class MemoryConversationStore:
+    """Historial por sesión en memoria, acotado.
+
+    Cada sesión guarda sus últimos HISTORY_SIZE mensajes en un buffer
+    circular, junto con el `context` de Ollama del último turno; las
+    sesiones inactivas se expulsan y nunca hay más de MAX_SESSIONS.
+    Como los mensajes no tienen largo fijo, también se suman los tokens
+    de todas las sesiones (mensajes y `context`) y, pasado MAX_STORE_TOKENS,
+    se expulsan las menos usadas. Solo sirve para un proceso.
+    """
+    def __init__(self, history_size=HISTORY_SIZE, idle_seconds=SESSION_IDLE_SECONDS, max_sessions=MAX_SESSIONS,
+                 max_tokens=MAX_STORE_TOKENS):
+        self.history_size = history_size
+        self.idle_seconds = idle_seconds
+        self.max_sessions = max_sessions
+        self.max_tokens = max_tokens
+        self.tokens = 0
+        self.sessions = OrderedDict()  # session_id -> sesión, la menos usada primero
+        self.lock = threading.Lock()
+
+    def evict(self, now):
+        # Debe llamarse con el lock tomado; la sesión recién usada (la última) se queda
+        while self.sessions:
+            session_id, session = next(iter(self.sessions.items()))
+            full = (len(self.sessions) > self.max_sessions
+                    or (self.tokens > self.max_tokens and len(self.sessions) > 1))
+            if not full and now - session['last_access'] < self.idle_seconds:
+                break
+            self.remove(session_id)
+
+    def remove(self, session_id):
+        session = self.sessions.pop(session_id, None)
+        if session is not None:
+            self.tokens -= session['tokens']
+
+    def touch(self, session_id):
+        # Debe llamarse con el lock tomado
+        session = self.sessions.pop(session_id, None)
+        if session is None:
+            session = {'messages': deque(maxlen=self.history_size), 'context': None, 'tokens': 0}
+        session['last_access'] = time.monotonic()
+        self.sessions[session_id] = session
+        return session
+
+    def resize(self, session, delta):
+        session['tokens'] += delta
+        self.tokens += delta
+        self.evict(session['last_access'])
+
+    def history(self, session_id):
+        with self.lock:
+            session = self.sessions.get(session_id)
+            return list(session['messages']) if session else []
+
+    def append(self, session_id, message):
+        message = dict(message, tokens=estimate_tokens(message['content']))
+        with self.lock:
+            session = self.touch(session_id)
+            messages = session['messages']
+            # El buffer circular descarta el más antiguo al llenarse
+            dropped = messages[0]['tokens'] if len(messages) == messages.maxlen else 0
+            messages.append(message)
+            self.resize(session, message['tokens'] - dropped)
+
+    def get_context(self, session_id):
+        with self.lock:
+            session = self.sessions.get(session_id)
+            return session['context'] if session else None
+
+    def set_context(self, session_id, personality, context):
+        with self.lock:
+            session = self.touch(session_id)
+            old = session['context']
+            session['context'] = (personality, context)
+            self.resize(session, len(context) - (len(old[1]) if old else 0))
+
+    def clear(self, session_id):
+        with self.lock:
+            self.remove(session_id)
+
+class SQLiteConversationStore:
+    """Historial por sesión en SQLite, compartido entre procesos (modo WAL)"""
+    def __init__(self, path, history_size=HISTORY_SIZE, idle_seconds=SESSION_IDLE_SECONDS):
+        self.path = path
+        self.history_size = history_size
+        self.idle_seconds = idle_seconds
+        self.last_eviction = 0
+        self.local = threading.local()
+        db = self.connection()
+        db.execute("""CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, session TEXT NOT NULL,
+            role TEXT NOT NULL, content TEXT NOT NULL, created REAL NOT NULL)""")
+        db.execute("CREATE INDEX IF NOT EXISTS messages_session ON messages (session, id)")
+        db.execute("CREATE INDEX IF NOT EXISTS messages_created ON messages (created)")
+        db.execute("""CREATE TABLE IF NOT EXISTS contexts (
+            session TEXT PRIMARY KEY, personality TEXT NOT NULL, context TEXT NOT NULL)""")
+
+    def connection(self):
+        # Las conexiones de sqlite3 no se comparten entre hilos
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            self.local.db = db
+        return db
+
+    def history(self, session_id):
+        rows = self.connection().execute(
+            "SELECT role, content FROM messages WHERE session = ? ORDER BY id DESC LIMIT ?",
+            (session_id, self.history_size)).fetchall()
+        return [{'role': role, 'content': content, 'tokens': estimate_tokens(content)}
+                for role, content in reversed(rows)]
+
+    def append(self, session_id, message):
+        now = time.time()
+        db = self.connection()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("INSERT INTO messages (session, role, content, created) VALUES (?, ?, ?, ?)",
+                       (session_id, message['role'], message['content'], now))
+            # Buffer circular: solo quedan los últimos mensajes de la sesión
+            db.execute("""DELETE FROM messages WHERE session = ? AND id <= (
+                SELECT id FROM messages WHERE session = ? ORDER BY id DESC LIMIT 1 OFFSET ?)""",
+                (session_id, session_id, self.history_size))
+            # Expulsar sesiones inactivas (como mucho una vez por minuto)
+            if now - self.last_eviction > 60:
+                self.last_eviction = now
+                db.execute("""DELETE FROM messages WHERE session IN (
+                    SELECT session FROM messages GROUP BY session HAVING MAX(created) < ?)""",
+                    (now - self.idle_seconds,))
+                db.execute("DELETE FROM contexts WHERE session NOT IN (SELECT session FROM messages)")
+
+    def get_context(self, session_id):
+        row = self.connection().execute(
+            "SELECT personality, context FROM contexts WHERE session = ?", (session_id,)).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def set_context(self, session_id, personality, context):
+        self.connection().execute("INSERT OR REPLACE INTO contexts (session, personality, context) VALUES (?, ?, ?)",
+                                  (session_id, personality, json.dumps(context)))
+
+    def clear(self, session_id):
+        db = self.connection()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("DELETE FROM messages WHERE session = ?", (session_id,))
+            db.execute("DELETE FROM contexts WHERE session = ?", (session_id,))
+
+if CHAT_STORE == 'sqlite':
+    conversations = SQLiteConversationStore(CHAT_DB)
+else:
+    conversations = MemoryConversationStore()
+
+# ============ CONSTRUCCIÓN DEL PROMPT ============
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', 1500))
+
+class ContextBuilder:
+    """Arma el prompt de cada turno dentro de un presupuesto de tokens.
+
+    Si Ollama nos devolvió su `context` del turno anterior (con la misma
+    personalidad) y aún cabe en el presupuesto, solo se manda el mensaje
+    nuevo y el modelo no vuelve a procesar el historial. Si no, se arma
+    el prompt completo con los mensajes más recientes que quepan; el
+    prefijo de cada personalidad se calcula una sola vez.
+    """
+    def __init__(self, budget=CONTEXT_TOKEN_BUDGET):
+        self.budget = budget
+        self.prefixes = {
+            key: (f"{p['prompt']}\n\n", estimate_tokens(p['prompt']))
+            for key, p in PERSONALITIES.items()
+        }
+
+    def build(self, personality, history, context=None):
+        """Devuelve (prompt, context) para la siguiente llamada a Ollama"""
+        name = PERSONALITIES[personality]['name']
+        last = history[-1]
+        if context is not None and context[0] == personality and len(context[1]) + last['tokens'] <= self.budget:
+            return f"Usuario: {last['content']}\n{name}:", context[1]
+        
+        prefix, used = self.prefixes[personality]
+        lines = []
+        # Del más reciente al más antiguo hasta agotar el presupuesto
+        for msg in reversed(history):
+            content = msg['content']
+            if used + msg['tokens'] > self.budget:
+                if lines:
+                    break
+                # El mensaje más reciente va siempre, pero recortado a lo que
+                # queda del presupuesto (se conserva el final, donde suele
+                # estar la pregunta)
+                content = "…" + content[-max(self.budget - used - 1, 1) * 4:]
+            used += msg['tokens']
+            role = "Usuario" if msg['role'] == 'user' else name
+            lines.append(f"{role}: {content}\n")
+        return prefix + ''.join(reversed(lines)) + f"{name}:", None
+
+context_builder = ContextBuilder()
+
+def get_session_id():
+    """Id de la conversación: del cuerpo de la petición o de la cookie"""
+    data = request.get_json(silent=True) or {}
+    session_id = data.get('session_id') or request.cookies.get('chat_session')
+    if not session_id:
+        session_id = g.new_session_id = uuid.uuid4().hex
+    return session_id
+
+@app.after_request
+def set_session_cookie(response):
+    if 'new_session_id' in g:
+        response.set_cookie('chat_session', g.new_session_id, httponly=True, samesite='Lax')
+    return response
 
 @app.route('/')
 def index():
     """Sirve la página principal"""
     return render_template('index.html', personalities=PERSONALITIES)
 
+def sse(data):
+    """Formatea un evento Server-Sent Events"""
+    return f"data: {json.dumps(data)}\n\n"
+
+def ollama_payload(full_prompt, context, stream):
+    payload = {
+        "model": MODEL_NAME,
+        "prompt": full_prompt,
+        "stream": stream,
+        "temperature": 0.7
+    }
+    if context is not None:
+        payload["context"] = context
+    return payload
+
+def stream_reply(full_prompt, context, personality, session_id):
+    """Reenvía los tokens de Ollama al navegador conforme llegan"""
+    parts = []
+    new_context = None
+    try:
+        with requests.post(OLLAMA_API_URL,
+            json=ollama_payload(full_prompt, context, True),
+            stream=True,
+            timeout=30
+        ) as response:
+            if response.status_code != 200:
+                yield sse({'error': 'Error al comunicarse con Ollama'})
+                return
+            # Ollama manda un objeto JSON por línea
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                token = chunk.get('response', '')
+                if token:
+                    parts.append(token)
+                    yield sse({'token': token})
+                if chunk.get('done'):
+                    new_context = chunk.get('context')
+                    break
+    except (requests.RequestException, ValueError) as e:
+        print(f"Error: {e}")
+        yield sse({'error': str(e)})
+        return
+    
+    # Guardar la respuesta completa en el historial
+    bot_response = ''.join(parts)
+    conversations.append(session_id, {
+        'role': 'assistant',
+        'content': bot_response
+    })
+    if new_context:
+        conversations.set_context(session_id, personality, new_context)
+    yield sse({'done': True, 'personality_name': PERSONALITIES[personality]['name']})
+
 @app.route('/chat', methods=['POST'])
 def chat():
     """Endpoint principal del chat"""
@@ -70,44 +352,44 @@ def chat():
         if not user_message:
             return jsonify({'error': 'Mensaje vacío'}), 400
         
+        session_id = get_session_id()
+        
         # Agregar mensaje del usuario al historial
-        conversation_history.append({
+        conversations.append(session_id, {
             'role': 'user',
             'content': user_message
         })
         
         # Construir el prompt con personalidad y contexto
-        system_prompt = PERSONALITIES[personality]['prompt']
-        
-        # Crear el prompt completo con historial
-        full_prompt = f"{system_prompt}\n\n"
-        
-        # Agregar historial reciente (últimos 10 mensajes)
-        for msg in conversation_history[-10:]:
-            role = "Usuario" if msg['role'] == 'user' else PERSONALITIES[personality]['name']
-            full_prompt += f"{role}: {msg['content']}\n"
+        full_prompt, context = context_builder.build(
+            personality,
+            conversations.history(session_id),
+            conversations.get_context(session_id)
+        )
         
-        full_prompt += f"{PERSONALITIES[personality]['name']}:"
+        # Modo streaming: los tokens se envían conforme se generan
+        if data.get('stream'):
+            return Response(stream_with_context(stream_reply(full_prompt, context, personality, session_id)),
+                            mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
         
         # Llamar a Ollama API
         response = requests.post(OLLAMA_API_URL, 
-            json={
-                "model": MODEL_NAME,
-                "prompt": full_prompt,
-                "stream": False,
-                "temperature": 0.7
-            },
+            json=ollama_payload(full_prompt, context, False),
             timeout=30
         )
         
         if response.status_code == 200:
-            bot_response = response.json()['response']
+            result = response.json()
+            bot_response = result['response']
             
             # Agregar respuesta del bot al historial
-            conversation_history.append({
+            conversations.append(session_id, {
                 'role': 'assistant',
                 'content': bot_response
             })
+            if result.get('context'):
+                conversations.set_context(session_id, personality, result['context'])
             
             return jsonify({
                 'response': bot_response,
@@ -123,8 +405,7 @@ def chat():
 @app.route('/clear', methods=['POST'])
 def clear_history():
     """Limpia el historial de conversación"""
-    global conversation_history
-    conversation_history = []
+    conversations.clear(get_session_id())
     return jsonify({'message': 'Historial limpiado'})
 
 if __name__ == '__main__':
@@ -0,0 +1,241 @@
+"""Modo asíncrono (ASGI) del servidor MCP.
+
+/chat-llm y /chat-compose se atienden con corrutinas: mientras esperan a
+Ollama no ocupan ningún hilo, así que miles de esperas comparten el event
+loop. El resto de rutas (/execute, /tools, /, ...) son rápidas y se pasan
+tal cual a la app Flask de server.py, que corre en su propio pool de hilos.
+
+Uso (desde la carpeta MCP):
+    pip install uvicorn httpx a2wsgi
+    uvicorn asgi:app --port 5000
+"""
+import asyncio
+import json
+import os
+import time
+
+import httpx
+from a2wsgi import WSGIMiddleware
+
+import server
+from server import (OllamaError, ResponseCache, OLLAMA_CONNECT_TIMEOUT, RESPONSE_TIMEOUT,
+                    RETRY_BACKOFF, RETRY_STATUSES, STEP_TIMEOUT, keyword_matcher, router_stats)
+
+# ============ CLIENTE OLLAMA ASÍNCRONO ============
+class AsyncOllamaClient:
+    """Cliente de Ollama sin bloqueo.
+
+    Comparte el circuito y la caché de respuestas con el cliente síncrono
+    de server.py, así que ambos modos ven el mismo estado de Ollama, y
+    reintenta igual que él: errores de conexión y 502/503/504 con backoff
+    exponencial, nunca una lectura que ya empezó.
+    """
+    def __init__(self, sync_client, max_connections=100, retries=2):
+        self.sync = sync_client
+        self.retries = retries
+        self.client = httpx.AsyncClient(
+            base_url=sync_client.base_url,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        )
+
+    async def request(self, method, path, timeout, **kwargs):
+        if not self.sync.breaker.allow():
+            raise OllamaError("Ollama no disponible (circuito abierto)")
+        for attempt in range(self.retries + 1):
+            if attempt > 1:
+                # Mismos tiempos que urllib3: el primer reintento es inmediato
+                await asyncio.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+            try:
+                # Sin límite para esperar conexión libre: el timeout de lectura ya acota cada llamada
+                response = await self.client.request(method, path, timeout=httpx.Timeout(
+                    timeout, connect=OLLAMA_CONNECT_TIMEOUT, pool=None), **kwargs)
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                if attempt < self.retries:
+                    continue
+                self.sync.breaker.record_failure()
+                raise OllamaError(str(e) or type(e).__name__) from e
+            except httpx.HTTPError as e:
+                self.sync.breaker.record_failure()
+                raise OllamaError(str(e) or type(e).__name__) from e
+            if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                break
+        return self.sync.handle_response(response)
+
+    async def generate(self, prompt, options=None, timeout=RESPONSE_TIMEOUT, cache=False):
+        """Igual que OllamaClient.generate, pero sin bloquear el event loop"""
+        options = options or {}
+        if cache:
+            key = ResponseCache.key(self.sync.model, prompt, options)
+            cached = self.sync.cache.get(key)
+            if cached is not None:
+                return cached
+        data = await self.request('POST', '/api/generate', timeout, json={
+            'model': self.sync.model,
+            'prompt': prompt,
+            'stream': False,
+            'options': options
+        })
+        response = data.get('response', '')
+        if cache and response and self.sync.cache.put(key, response, autosave=False):
+            # Volcar la caché a disco es E/S bloqueante: fuera del event loop
+            await asyncio.get_running_loop().run_in_executor(None, self.sync.cache.save)
+        return response
+
+ollama = AsyncOllamaClient(server.ollama)
+
+# ============ DECISIÓN Y WORKFLOWS ASÍNCRONOS ============
+async def generate_llm_response(message):
+    try:
+        return server.llm_response(await ollama.generate(**server.response_request(message)))
+    except OllamaError as e:
+        return server.llm_error_response(e)
+
+async def route_tool(message, match):
+    start = time.perf_counter()
+    tool = server.route_locally(match, start)
+    if tool is not None:
+        return tool
+    try:
+        tool = server.parse_decision(await ollama.generate(**server.decide_request(message)))
+    except OllamaError as e:
+        print(f"❌ Error Ollama: {e}")
+        tool = None
+    router_stats.record('llm', time.perf_counter() - start)
+    return tool
+
+async def execute_with_llm_decision(message):
+    match = keyword_matcher.match(message)
+    tool_choice = await route_tool(message, match)
+    result = server.execute_tool_choice(message, match, tool_choice)
+    return result or await generate_llm_response(message)
+
+async def plan_workflow_with_llm(message):
+    try:
+        return server.parse_plan(await ollama.generate(**server.planning_request(message)), message)
+    except OllamaError as e:
+        print(f"❌ Error planeando workflow: {e}")
+        return server.analyze_message_for_workflow(message)
+
+async def synthesize_results(message, results):
+    try:
+        analysis = await ollama.generate(**server.synthesis_request(message, results))
+        return server.synthesis_response(analysis, results)
+    except OllamaError as e:
+        print(f"❌ Error en síntesis: {e}")
+    return server.synthesis_fallback(results)
+
+async def execute_workflow(message, plan):
+    """Cada paso es una tarea que espera a sus dependencias; las herramientas
+    corren en el pool de workflows de server.py con su tiempo límite"""
+    steps = server.workflow_steps(plan)
+    if steps is None:
+        return await execute_with_llm_decision(message)
+    
+    deps = server.step_dependencies(steps)
+    loop = asyncio.get_running_loop()
+    tasks = {}
+    
+    async def run(step):
+        num = step["step"]
+        for dep in deps[num]:
+            if 'error' in await tasks[dep]:
+                return {"error": f"Omitido: falló el paso {dep}"}
+        running = loop.create_future()
+        future = loop.run_in_executor(server.workflow_pool, server.timed_step, message, step,
+                                      lambda: loop.call_soon_threadsafe(running.set_result, None))
+        try:
+            # El tiempo en la cola del pool no cuenta para el límite
+            await asyncio.wait({running, future}, return_when=asyncio.FIRST_COMPLETED)
+            return {"result": await asyncio.wait_for(future, STEP_TIMEOUT)}
+        except asyncio.TimeoutError:
+            # El hilo no se puede interrumpir, pero su resultado se descarta
+            print(f"⏱️ Paso {num} cancelado por tiempo")
+            return {"error": f"Tiempo agotado ({STEP_TIMEOUT}s)"}
+        except Exception as e:
+            return {"error": str(e)}
+    
+    # En orden topológico, cada tarea encuentra ya creadas las de sus dependencias
+    by_num = {step["step"]: step for step in steps}
+    for num in server.step_order(deps):
+        tasks[num] = asyncio.ensure_future(run(by_num[num]))
+    outcomes = {num: {"error": "Dependencia circular"} for num in by_num}
+    outcomes.update(zip(tasks, await asyncio.gather(*tasks.values())))
+    results = server.ordered_results(steps, outcomes)
+    
+    # Si necesita análisis, sintetizar resultados
+    if plan.get("needs_analysis", False):
+        return await synthesize_results(message, results)
+    return results[-1] if results else {"response": "No se ejecutó ninguna acción"}
+
+# ============ ENDPOINTS ASÍNCRONOS ============
+async def chat_with_llm(message):
+    result = await execute_with_llm_decision(message)
+    print(f"\n📝 Mensaje: {message}")
+    print(f"🧠 Procesado con LLM (async)")
+    print(f"🔧 Herramienta: {result.get('tool_used', 'ninguna')}")
+    return result
+
+async def chat_compose(message):
+    print(f"\n🎯 Planificando workflow para: {message}")
+    plan = await plan_workflow_with_llm(message)
+    print(f"📋 Plan: {plan.get('workflow', [])}")
+    result = await execute_workflow(message, plan)
+    print(f"📊 Pasos ejecutados: {result.get('workflow_steps', 0)}")
+    return result
+
+ASYNC_ROUTES = {
+    '/chat-llm': chat_with_llm,
+    '/chat-compose': chat_compose
+}
+
+FLASK_WORKERS = int(os.environ.get('FLASK_WORKERS', 10))
+flask_app = WSGIMiddleware(server.app, workers=FLASK_WORKERS)
+
+async def read_body(receive):
+    body = b''
+    while True:
+        event = await receive()
+        body += event.get('body', b'')
+        if not event.get('more_body'):
+            return body
+
+async def send_json(send, status, data):
+    body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+            (b'access-control-allow-origin', b'*')  # Igual que CORS(app) en server.py
+        ]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+async def app(scope, receive, send):
+    """Aplicación ASGI: rutas de LLM nativas y el resto vía Flask"""
+    handler = ASYNC_ROUTES.get(scope.get('path')) if scope['type'] == 'http' else None
+    if handler is None or scope['method'] != 'POST':
+        # Incluye OPTIONS (preflight CORS), que responde flask_cors
+        if scope['type'] == 'lifespan':
+            return await lifespan(receive, send)
+        return await flask_app(scope, receive, send)
+    
+    try:
+        data = json.loads(await read_body(receive) or b'{}')
+    except ValueError:
+        return await send_json(send, 400, {"error": "JSON inválido"})
+    message = data.get('message', '') if isinstance(data, dict) else ''
+    if not message:
+        return await send_json(send, 400, {"error": "No se proporcionó mensaje"})
+    await send_json(send, 200, await handler(message))
+
+async def lifespan(receive, send):
+    while True:
+        event = await receive()
+        if event['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif event['type'] == 'lifespan.shutdown':
+            await ollama.client.aclose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
@@ -1,13 +1,259 @@
 from flask import Flask, request, jsonify, render_template
 from flask_cors import CORS
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import atexit
+import hashlib
+import json
+import os
 import random
+import re
+import threading
+import time
 from datetime import datetime
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 app = Flask(__name__)
 CORS(app)
 
+# ============ CLIENTE OLLAMA ============
+OLLAMA_URL = os.environ.get('OLLAMA_URL', 'http://127.0.0.1:11434')
+OLLAMA_MODEL = os.environ.get('OLLAMA_MODEL', 'phi')
+
+# Timeouts de lectura por tipo de llamada (segundos); conectar nunca debería tardar
+OLLAMA_CONNECT_TIMEOUT = 3
+DECIDE_TIMEOUT = 20
+PLAN_TIMEOUT = 60
+SYNTHESIS_TIMEOUT = 90
+RESPONSE_TIMEOUT = 60
+HEALTH_TIMEOUT = 3
+
+# Reintentos ante errores de conexión y estas respuestas (backoff exponencial)
+RETRY_STATUSES = (502, 503, 504)
+RETRY_BACKOFF = 0.5
+
+class OllamaError(Exception):
+    """Ollama no respondió o respondió con error"""
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+class CircuitBreaker:
+    """Deja de llamar a Ollama tras varios fallos seguidos.
+
+    Con el circuito abierto las llamadas fallan al instante; pasado
+    `reset_timeout` se deja pasar una llamada de prueba y, si funciona,
+    se vuelve a cerrar.
+    """
+    def __init__(self, max_failures=3, reset_timeout=30):
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Medio abierto: una sola llamada de prueba
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.max_failures:
+                self.opened_at = time.monotonic()
+
+    def state(self):
+        with self.lock:
+            return 'abierto' if self.opened_at is not None else 'cerrado'
+
+# Caché de respuestas para las llamadas deterministas (decisión y planificación)
+OLLAMA_CACHE_SIZE = int(os.environ.get('OLLAMA_CACHE_SIZE', 1024))
+OLLAMA_CACHE_TTL = int(os.environ.get('OLLAMA_CACHE_TTL', 3600))
+OLLAMA_CACHE_FILE = os.environ.get('OLLAMA_CACHE_FILE')  # Opcional: persistir en disco
+
+class ResponseCache:
+    """Caché LRU con TTL de respuestas de Ollama.
+
+    La clave es un hash de (modelo, prompt, opciones). Si se indica un
+    archivo, las entradas se cargan al iniciar y se guardan en disco
+    como mucho cada `save_interval` segundos y al salir.
+    """
+    def __init__(self, max_entries=OLLAMA_CACHE_SIZE, ttl=OLLAMA_CACHE_TTL, path=OLLAMA_CACHE_FILE, save_interval=10):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.save_interval = save_interval
+        self.entries = OrderedDict()  # clave -> (respuesta, creada), la menos usada primero
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.dirty = False
+        self.last_save = time.monotonic()
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        if path:
+            self.load()
+            atexit.register(self.save)
+
+    @staticmethod
+    def key(model, prompt, options):
+        raw = json.dumps([model, prompt, options], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[1] < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, response, autosave=True):
+        """Guarda una respuesta; devuelve True si toca persistir en disco.
+
+        Con `autosave=False` quien llama decide dónde correr save() (el
+        modo asíncrono lo manda a un hilo para no bloquear el event loop).
+        """
+        with self.lock:
+            self.entries[key] = (response, time.time())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+            self.dirty = True
+            save = bool(self.path) and time.monotonic() - self.last_save >= self.save_interval
+            if save:
+                # Nadie más lanza otro guardado mientras este está en camino
+                self.last_save = time.monotonic()
+        if save and autosave:
+            self.save()
+        return save
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        for key, response, created in stored[-self.max_entries:]:
+            if now - created < self.ttl:
+                self.entries[key] = (response, created)
+
+    def save(self):
+        # Un guardado a la vez, para que uno viejo no pise a uno más nuevo
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                stored = [[key, response, created] for key, (response, created) in self.entries.items()]
+                self.dirty = False
+                self.last_save = time.monotonic()
+            # Escritura atómica: nunca queda un archivo a medias
+            tmp = f"{self.path}.tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(stored, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / total, 3) if total else 0.0
+            }
+
+class OllamaClient:
+    """Cliente compartido de Ollama con conexiones keep-alive reutilizadas"""
+    def __init__(self, base_url=OLLAMA_URL, model=OLLAMA_MODEL, pool_size=10, retries=2):
+        self.base_url = base_url.rstrip('/')
+        self.model = model
+        self.breaker = CircuitBreaker()
+        self.cache = ResponseCache()
+        # Reintenta errores de conexión y 502/503/504 con backoff exponencial;
+        # nunca reintenta una lectura que ya empezó (la generación es cara)
+        retry = Retry(total=retries, connect=retries, read=0, status=retries,
+                      backoff_factor=RETRY_BACKOFF, status_forcelist=RETRY_STATUSES,
+                      allowed_methods=frozenset({'GET', 'POST'}), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, path, timeout, **kwargs):
+        if not self.breaker.allow():
+            raise OllamaError("Ollama no disponible (circuito abierto)")
+        try:
+            response = self.session.request(method, f"{self.base_url}{path}",
+                                            timeout=(OLLAMA_CONNECT_TIMEOUT, timeout), **kwargs)
+        except requests.RequestException as e:
+            self.breaker.record_failure()
+            raise OllamaError(str(e)) from e
+        return self.handle_response(response)
+
+    def handle_response(self, response):
+        """Registra el resultado en el circuito y devuelve el JSON"""
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        if response.status_code != 200:
+            raise OllamaError(f"Ollama respondió {response.status_code}", response.status_code)
+        try:
+            return response.json()
+        except ValueError as e:
+            raise OllamaError("Respuesta inválida de Ollama") from e
+
+    def generate(self, prompt, options=None, timeout=RESPONSE_TIMEOUT, cache=False):
+        """Genera texto con el modelo configurado.
+
+        Con `cache=True` una respuesta ya obtenida para el mismo modelo,
+        prompt y opciones se devuelve sin llamar a Ollama.
+        """
+        options = options or {}
+        if cache:
+            key = ResponseCache.key(self.model, prompt, options)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+        data = self.request('POST', '/api/generate', timeout, json={
+            'model': self.model,
+            'prompt': prompt,
+            'stream': False,
+            'options': options
+        })
+        response = data.get('response', '')
+        if cache and response:
+            self.cache.put(key, response)
+        return response
+
+    def tags(self, timeout=HEALTH_TIMEOUT):
+        """Modelos instalados en Ollama"""
+        return self.request('GET', '/api/tags', timeout).get('models', [])
+
+ollama = OllamaClient()
+
 # ============ HERRAMIENTA: CALCULADORA ============
 def calculator(operation, a, b):
     """Calculadora simple con operaciones básicas"""
@@ -75,58 +321,166 @@ def text_processor(text, operation):
     
     return f"Operación '{operation}' no soportada"
 
+# ============ MOTOR DE PALABRAS CLAVE ============
+# Peso de cada palabra clave por herramienta: 2 = casi siempre indica la
+# herramienta, 1 = pista débil ("por", "tiempo", "-" aparecen en cualquier frase).
+# El clasificador local solo decide si hay al menos una palabra fuerte.
+# El orden de las herramientas es la prioridad del decisor por palabras clave.
+TOOL_KEYWORDS = {
+    'calculator': {
+        'suma': 2, 'sumar': 2, 'resta': 2, 'restar': 2, 'multiplica': 2, 'multiplicar': 2,
+        'divide': 2, 'dividir': 2, 'calcula': 2, 'cuánto es': 2, 'plus': 2, 'minus': 2,
+        'times': 2, 'divided': 2, '+': 2, '×': 2, '÷': 2, '*': 2,
+        'más': 1, 'menos': 1, 'por': 1, 'entre': 1, '-': 1, '/': 1
+    },
+    'weather': {
+        'clima': 2, 'temperatura': 2, 'weather': 2, 'llueve': 2, 'lluvia': 2, 'pronóstico': 2,
+        'tiempo': 1, 'sol': 1, 'calor': 1, 'frío': 1
+    },
+    'text_processor': {
+        'mayúscula': 2, 'minúscula': 2, 'uppercase': 2, 'lowercase': 2, 'reversa': 2,
+        'reverse': 2, 'voltear': 2, 'palabra': 2,
+        'contar': 1, 'texto': 1
+    }
+}
+
+STRONG_WEIGHT = 2
+
+# Palabras clave de cada operación, en orden de prioridad
+OPERATION_KEYWORDS = {
+    'calculator': {
+        'add': ['suma', 'sumar', 'más', '+', 'plus'],
+        'subtract': ['resta', 'restar', 'menos', '-', 'minus'],
+        'multiply': ['multiplica', 'multiplicar', 'por', '×', '*', 'times'],
+        'divide': ['divide', 'dividir', 'entre', '÷', '/', 'divided']
+    },
+    'text_processor': {
+        'uppercase': ['mayúscula', 'uppercase'],
+        'lowercase': ['minúscula', 'lowercase'],
+        'reverse': ['reversa', 'reverse', 'voltear'],
+        'count_words': ['palabra', 'words']
+    }
+}
+
+CITIES = ['madrid', 'barcelona', 'mexico', 'new york', 'tokyo', 'paris', 'london', 'berlin', 'rome']
+QUOTED_PATTERN = re.compile(r'"([^"]*)"')
+
+class KeywordMatch:
+    """Lo que encontró el motor en un mensaje: puntuación por herramienta,
+    operaciones mencionadas, números y ciudades"""
+    def __init__(self, scores, strong, operations, numbers, cities):
+        self.scores = scores
+        self.strong = strong  # herramientas con alguna palabra clave fuerte
+        self.operations = operations
+        self.numbers = numbers
+        self.cities = cities
+
+    def first_tool(self):
+        """Primera herramienta (por prioridad) con alguna coincidencia"""
+        return next((tool for tool, score in self.scores.items() if score > 0), None)
+
+    def classify(self):
+        """Devuelve (herramienta, confianza): la ventaja de la mejor sobre la
+        segunda, o 0 si la mejor solo tiene pistas débiles"""
+        ranked = sorted(self.scores.values(), reverse=True)
+        if ranked[0] == 0:
+            return None, 0
+        best = max(self.scores, key=self.scores.get)
+        if best not in self.strong:
+            return best, 0
+        return best, ranked[0] - ranked[1]
+
+    def operation(self, tool, default):
+        found = self.operations[tool]
+        return next((op for op in OPERATION_KEYWORDS[tool] if op in found), default)
+
+    def city(self, default='Madrid'):
+        return self.cities[0] if self.cities else default
+
+class KeywordMatcher:
+    """Motor de palabras clave compartido por los dos routers.
+
+    Las tablas de herramientas, operaciones y ciudades se compilan al
+    iniciar en una sola expresión regular (junto con los números), así que
+    cada mensaje se recorre una vez sin importar cuántas herramientas haya.
+    """
+    def __init__(self, tools=TOOL_KEYWORDS, operations=OPERATION_KEYWORDS, cities=CITIES):
+        self.tools = list(tools)
+        self.labels = {}  # palabra clave -> [(tipo, nombre, peso)]
+        for tool, table in tools.items():
+            for keyword, weight in table.items():
+                self.labels.setdefault(keyword, []).append(('tool', tool, weight))
+        for tool, table in operations.items():
+            for operation, keywords in table.items():
+                for keyword in keywords:
+                    self.labels.setdefault(keyword, []).append(('operation', tool, operation))
+        for city in cities:
+            self.labels.setdefault(city, []).append(('city', city.title(), None))
+        # Las palabras coinciden completas, con plural opcional ("sol" no está
+        # en "solo"); los símbolos coinciden en cualquier parte. Las más largas
+        # primero para que "cuánto es" gane a prefijos más cortos. Los números van
+        # antes que todo: "-5" es un número, pero en "10-5" el guion es una resta.
+        alternatives = [
+            rf'\b{re.escape(keyword)}(?:s|es)?\b' if keyword[0].isalnum() else re.escape(keyword)
+            for keyword in sorted(self.labels, key=len, reverse=True)
+        ]
+        self.pattern = re.compile(r'(?P<number>(?:(?<!\d)-)?\d+\.?\d*)|' + '|'.join(alternatives))
+        self.operation_tools = list(operations)
+
+    def keyword(self, matched):
+        # Quita el plural que la expresión regular dejó pasar
+        if matched in self.labels:
+            return matched
+        return matched[:-1] if matched[:-1] in self.labels else matched[:-2]
+
+    def match(self, message):
+        scores = dict.fromkeys(self.tools, 0)
+        strong = set()
+        operations = {tool: set() for tool in self.operation_tools}
+        numbers = []
+        cities = []
+        for found in self.pattern.finditer(message.lower()):
+            if found.group('number') is not None:
+                numbers.append(found.group('number'))
+                continue
+            for kind, name, value in self.labels[self.keyword(found.group())]:
+                if kind == 'tool':
+                    scores[name] += value
+                    if value >= STRONG_WEIGHT:
+                        strong.add(name)
+                elif kind == 'operation':
+                    operations[name].add(value)
+                else:
+                    cities.append(name)
+        # Sin dos números la calculadora no tiene con qué trabajar
+        if len(numbers) < 2:
+            scores['calculator'] = 0
+            strong.discard('calculator')
+        return KeywordMatch(scores, strong, operations, numbers, cities)
+
+keyword_matcher = KeywordMatcher()
+
 # ============ DECISOR INTELIGENTE ============
 def decide_and_execute(message):
     """Decide qué herramienta usar basándose en el mensaje"""
-    message_lower = message.lower()
-    
-    # Patrones para calculadora
-    math_keywords = ['suma', 'sumar', 'más', '+', 'resta', 'restar', 'menos', '-',
-                    'multiplica', 'multiplicar', 'por', '×', '*',
-                    'divide', 'dividir', 'entre', '÷', '/']
-    
-    # Patrones para clima
-    weather_keywords = ['clima', 'tiempo', 'temperatura', 'weather', 'llueve', 'sol']
-    
-    # Patrones para texto
-    text_keywords = ['mayúscula', 'minúscula', 'reversa', 'voltear', 'contar', 'palabras']
+    match = keyword_matcher.match(message)
+    tool = match.first_tool()
     
     # Decidir herramienta
-    if any(keyword in message_lower for keyword in math_keywords):
-        # Extraer números del mensaje
-        import re
-        numbers = re.findall(r'-?\d+\.?\d*', message)
-        if len(numbers) >= 2:
-            a, b = float(numbers[0]), float(numbers[1])
-            
-            # Determinar operación
-            if any(k in message_lower for k in ['suma', 'sumar', 'más', '+']):
-                operation = 'add'
-            elif any(k in message_lower for k in ['resta', 'restar', 'menos', '-']):
-                operation = 'subtract'
-            elif any(k in message_lower for k in ['multiplica', 'multiplicar', 'por', '×', '*']):
-                operation = 'multiply'
-            elif any(k in message_lower for k in ['divide', 'dividir', 'entre', '÷', '/']):
-                operation = 'divide'
-            else:
-                operation = 'add'  # default
-            
-            result = calculator(operation, a, b)
-            return {
-                'tool_used': 'calculator',
-                'parameters': {'operation': operation, 'a': a, 'b': b},
-                'result': result,
-                'response': f"He usado la calculadora: {a} {operation} {b} = {result}"
-            }
+    if tool == 'calculator':
+        a, b = float(match.numbers[0]), float(match.numbers[1])
+        operation = match.operation('calculator', 'add')
+        
+        result = calculator(operation, a, b)
+        return {
+            'tool_used': 'calculator',
+            'parameters': {'operation': operation, 'a': a, 'b': b},
+            'result': result,
+            'response': f"He usado la calculadora: {a} {operation} {b} = {result}"
+        }
     
-    elif any(keyword in message_lower for keyword in weather_keywords):
-        # Buscar nombre de ciudad (simplificado)
-        cities = ['madrid', 'barcelona', 'mexico', 'new york', 'tokyo', 'paris', 'london']
-        city = 'Madrid'  # default
-        for c in cities:
-            if c in message_lower:
-                city = c.title()
-                break
+    elif tool == 'weather':
+        city = match.city()
         
         result = weather_tool(city)
         return {
@@ -136,23 +490,11 @@ def decide_and_execute(message):
             'response': f"El clima en {city}: {result['temperature']}, {result['condition']}, Humedad: {result['humidity']}"
         }
     
-    elif any(keyword in message_lower for keyword in text_keywords):
+    elif tool == 'text_processor':
         # Extraer texto entre comillas si existe
-        import re
-        quoted = re.findall(r'"([^"]*)"', message)
+        quoted = QUOTED_PATTERN.findall(message)
         text = quoted[0] if quoted else message
-        
-        # Determinar operación
-        if 'mayúscula' in message_lower:
-            operation = 'uppercase'
-        elif 'minúscula' in message_lower:
-            operation = 'lowercase'
-        elif 'reversa' in message_lower or 'voltear' in message_lower:
-            operation = 'reverse'
-        elif 'contar' in message_lower and 'palabra' in message_lower:
-            operation = 'count_words'
-        else:
-            operation = 'count_chars'
+        operation = match.operation('text_processor', 'count_chars')
         
         result = text_processor(text, operation)
         return {
@@ -169,9 +511,66 @@ def decide_and_execute(message):
         'response': "No pude identificar qué herramienta usar. Puedo ayudarte con: cálculos matemáticos, información del clima, o procesamiento de texto."
     }
 
+# ============ CLASIFICADOR LOCAL ============
+LOCAL_ROUTER_THRESHOLD = int(os.environ.get('LOCAL_ROUTER_THRESHOLD', 2))
+
+class RouterStats:
+    """Aciertos y latencia de cada nivel del router (local / LLM)"""
+    def __init__(self):
+        self.tiers = {'local': [0, 0.0], 'llm': [0, 0.0]}
+        self.lock = threading.Lock()
+
+    def record(self, tier, seconds):
+        with self.lock:
+            self.tiers[tier][0] += 1
+            self.tiers[tier][1] += seconds
+
+    def snapshot(self):
+        with self.lock:
+            total = sum(count for count, _ in self.tiers.values())
+            return {
+                'threshold': LOCAL_ROUTER_THRESHOLD,
+                'total': total,
+                'tiers': {
+                    tier: {
+                        'count': count,
+                        'hit_rate': round(count / total, 3) if total else 0.0,
+                        'avg_ms': round(seconds / count * 1000, 3) if count else 0.0
+                    }
+                    for tier, (count, seconds) in self.tiers.items()
+                }
+            }
+
+router_stats = RouterStats()
+
+def route_locally(match, start):
+    """Nivel local del router; None si el mensaje es ambiguo"""
+    tool, confidence = match.classify()
+    if tool is not None and confidence >= LOCAL_ROUTER_THRESHOLD:
+        router_stats.record('local', time.perf_counter() - start)
+        print(f"⚡ Clasificador local: {tool} (confianza {confidence})")
+        return tool
+    return None
+
+def route_tool(message, match):
+    """Router por niveles: el clasificador local responde los casos claros
+    en microsegundos y solo los mensajes ambiguos llegan a Ollama"""
+    start = time.perf_counter()
+    tool = route_locally(match, start)
+    if tool is not None:
+        return tool
+    tool = decide_with_ollama(message)
+    router_stats.record('llm', time.perf_counter() - start)
+    return tool
+
 # ============ DECISIÓN CON LLM REAL ============
-def decide_with_ollama(message):
-    """Usa Ollama para decidir inteligentemente qué herramienta usar"""
+# Cada llamada al LLM se separa en "armar la petición" e "interpretar la
+# respuesta" para que el modo asíncrono (asgi.py) reutilice los mismos prompts
+def decide_request(message):
+    """Petición a Ollama para decidir qué herramienta usar"""
+    
+    # Mensajes que solo difieren en mayúsculas o espacios comparten caché
+    message = ' '.join(message.lower().split())
     
     # Crear prompt estructurado para el LLM
     system_prompt = """Eres un asistente que decide qué herramienta usar.
@@ -192,89 +591,71 @@ INSTRUCCIONES:
 
 Usuario: """ + message + "\nHerramienta:"
 
+    return {
+        'prompt': system_prompt,
+        'options': {
+            'temperature': 0.3,  # Más determinístico
+            'top_p': 0.9,
+            'num_predict': 20    # Respuesta corta
+        },
+        'timeout': DECIDE_TIMEOUT,
+        'cache': True
+    }
+
+def parse_decision(llm_response):
+    """Convierte la respuesta del LLM en el nombre de una herramienta"""
+    llm_response = llm_response.strip().lower()
+    print(f"🤖 LLM decidió: '{llm_response}'")
+    
+    # Limpiar respuesta del LLM
+    if 'calculator' in llm_response:
+        return 'calculator'
+    elif 'weather' in llm_response:
+        return 'weather'
+    elif 'text_processor' in llm_response or 'text' in llm_response:
+        return 'text_processor'
+    else:
+        return None  # No necesita herramientas
+
+def decide_with_ollama(message):
+    """Usa Ollama para decidir inteligentemente qué herramienta usar"""
     try:
         # Llamar a Ollama API
-        response = requests.post(
-            'http://localhost:11434/api/generate',
-            json={
-                'model': 'phi',
-                'prompt': system_prompt,
-                'stream': False,
-                'options': {
-                    'temperature': 0.3,  # Más determinístico
-                    'top_p': 0.9,
-                    'num_predict': 20    # Respuesta corta
-                }
-            },
-            timeout=150
-        )
-        
-        if response.status_code == 200:
-            llm_response = response.json()['response'].strip().lower()
-            print(f"🤖 LLM decidió: '{llm_response}'")
-            
-            # Limpiar respuesta del LLM
-            if 'calculator' in llm_response:
-                return 'calculator'
-            elif 'weather' in llm_response:
-                return 'weather'
-            elif 'text_processor' in llm_response or 'text' in llm_response:
-                return 'text_processor'
-            else:
-                return None  # No necesita herramientas
-        else:
-            print(f"❌ Error Ollama: {response.status_code}")
-            return None
-            
-    except Exception as e:
-        print(f"❌ Error conectando a Ollama: {e}")
+        return parse_decision(ollama.generate(**decide_request(message)))
+    except OllamaError as e:
+        print(f"❌ Error Ollama: {e}")
         return None
 
 def execute_with_llm_decision(message):
     """Usa LLM para decidir y luego ejecuta la herramienta"""
+    match = keyword_matcher.match(message)
+    
+    # 1. El clasificador local o el LLM deciden qué herramienta usar
+    tool_choice = route_tool(message, match)
     
-    # 1. El LLM decide qué herramienta usar
-    tool_choice = decide_with_ollama(message)
+    # 2. Ejecutar la herramienta o 3. responder directamente con el LLM
+    return execute_tool_choice(message, match, tool_choice) or generate_llm_response(message)
+
+def execute_tool_choice(message, match, tool_choice):
+    """Ejecuta la herramienta elegida; None si hay que responder con el LLM"""
     print(f"🔧 Herramienta elegida: {tool_choice}")
     
-    if tool_choice == 'calculator':
-        # 2a. Extraer parámetros para calculadora
-        import re
-        numbers = re.findall(r'-?\d+\.?\d*', message)
-        if len(numbers) >= 2:
-            a, b = float(numbers[0]), float(numbers[1])
-            
-            # Determinar operación
-            message_lower = message.lower()
-            if any(k in message_lower for k in ['suma', 'sumar', 'más', '+', 'plus']):
-                operation = 'add'
-            elif any(k in message_lower for k in ['resta', 'restar', 'menos', '-', 'minus']):
-                operation = 'subtract'
-            elif any(k in message_lower for k in ['multiplica', 'multiplicar', 'por', '×', '*', 'times']):
-                operation = 'multiply'
-            elif any(k in message_lower for k in ['divide', 'dividir', 'entre', '÷', '/', 'divided']):
-                operation = 'divide'
-            else:
-                operation = 'add'
-            
-            result = calculator(operation, a, b)
-            return {
-                'tool_used': 'calculator (LLM)',
-                'parameters': {'operation': operation, 'a': a, 'b': b},
-                'result': result,
-                'response': f"🤖 Usé la calculadora: {a} {operation} {b} = {result}"
-            }
+    if tool_choice == 'calculator' and len(match.numbers) >= 2:
+        # 2a. Parámetros para calculadora
+        a, b = float(match.numbers[0]), float(match.numbers[1])
+        operation = match.operation('calculator', 'add')
+        
+        result = calculator(operation, a, b)
+        return {
+            'tool_used': 'calculator (LLM)',
+            'parameters': {'operation': operation, 'a': a, 'b': b},
+            'result': result,
+            'response': f"🤖 Usé la calculadora: {a} {operation} {b} = {result}"
+        }
     
     elif tool_choice == 'weather':
-        # 2b. Extraer ciudad para clima
-        cities = ['madrid', 'barcelona', 'mexico', 'new york', 'tokyo', 'paris', 'london', 'berlin', 'rome']
-        city = 'Madrid'  # default
-        message_lower = message.lower()
-        
-        for c in cities:
-            if c in message_lower:
-                city = c.title()
-                break
+        # 2b. Ciudad para clima
+        city = match.city()
         
         result = weather_tool(city)
         return {
@@ -286,19 +667,9 @@ def execute_with_llm_decision(message):
     
     elif tool_choice == 'text_processor':
         # 2c. Procesar texto
-        import re
-        quoted = re.findall(r'"([^"]*)"', message)
+        quoted = QUOTED_PATTERN.findall(message)
         text = quoted[0] if quoted else message
-        
-        message_lower = message.lower()
-        if 'mayúscula' in message_lower or 'uppercase' in message_lower:
-            operation = 'uppercase'
-        elif 'minúscula' in message_lower or 'lowercase' in message_lower:
-            operation = 'lowercase'
-        elif 'reversa' in message_lower or 'reverse' in message_lower:
-            operation = 'reverse'
-        else:
-            operation = 'count_words'
+        operation = match.operation('text_processor', 'count_words')
         
         result = text_processor(text, operation)
         return {
@@ -308,13 +679,12 @@ def execute_with_llm_decision(message):
             'response': f"🤖 Procesé el texto: {result['result']}"
         }
     
-    else:
-        # 3. Respuesta directa del LLM sin herramientas
-        return generate_llm_response(message)
+    # Respuesta directa del LLM sin herramientas
+    return None
     
 # ============ SISTEMA DE WORKFLOWS INTELIGENTES ============
-def plan_workflow_with_llm(message):
-    """El LLM planifica un workflow de múltiples pasos"""
+def planning_request(message):
+    """Petición a Ollama para planificar un workflow de múltiples pasos"""
     
     planning_prompt = f"""Eres un planificador de tareas inteligente. El usuario necesita esto:
 
@@ -332,6 +702,7 @@ INSTRUCCIONES:
 - Si necesitas clima de 2+ ciudades, usa multi_weather
 - Si necesitas múltiples cálculos, usa batch_calculator
 - Si necesitas comparar o analizar datos, planifica en pasos
+- Si un paso necesita el resultado de otro, agrega "depends_on": [número de paso]
 - Responde en JSON con este formato:
 
 {{"workflow": [
@@ -342,42 +713,40 @@ INSTRUCCIONES:
 Usuario: {message}
 Planificación:"""
 
+    return {
+        'prompt': planning_prompt,
+        'options': {
+            'temperature': 0.3,
+            'num_predict': 200
+        },
+        'timeout': PLAN_TIMEOUT,
+        'cache': True
+    }
+
+def parse_plan(llm_response, message):
+    """Extrae el plan JSON de la respuesta del LLM"""
+    print(f"🤖 Plan generado: {llm_response[:200]}...")
+    
+    # Intentar extraer JSON
     try:
-        response = requests.post(
-            'http://127.0.0.1:11434/api/generate',
-            json={
-                'model': 'phi',
-                'prompt': planning_prompt,
-                'stream': False,
-                'options': {
-                    'temperature': 0.3,
-                    'num_predict': 200
-                }
-            },
-            timeout=150
-        )
-        
-        if response.status_code == 200:
-            llm_response = response.json()['response']
-            print(f"🤖 Plan generado: {llm_response[:200]}...")
-            
-            # Intentar extraer JSON
-            try:
-                import json
-                # Buscar JSON en la respuesta
-                start = llm_response.find('{')
-                end = llm_response.rfind('}') + 1
-                if start != -1 and end != 0:
-                    json_str = llm_response[start:end]
-                    plan = json.loads(json_str)
-                    return plan
-            except:
-                pass
-        
-        # Fallback: análisis simple
-        return analyze_message_for_workflow(message)
-        
-    except Exception as e:
+        # Buscar JSON en la respuesta
+        start = llm_response.find('{')
+        end = llm_response.rfind('}') + 1
+        if start != -1 and end != 0:
+            json_str = llm_response[start:end]
+            plan = json.loads(json_str)
+            return plan
+    except:
+        pass
+    
+    # Fallback: análisis simple
+    return analyze_message_for_workflow(message)
+
+def plan_workflow_with_llm(message):
+    """El LLM planifica un workflow de múltiples pasos"""
+    try:
+        return parse_plan(ollama.generate(**planning_request(message)), message)
+    except OllamaError as e:
         print(f"❌ Error planeando workflow: {e}")
         return analyze_message_for_workflow(message)
 
@@ -404,7 +773,6 @@ def analyze_message_for_workflow(message):
             }
     
     # Detectar múltiples cálculos
-    import re
     numbers = re.findall(r'\d+', message)
     if len(numbers) >= 4 and any(op in message_lower for op in ['suma', 'resta', 'calcula', 'operaciones']):
         return {
@@ -423,49 +791,163 @@ def analyze_message_for_workflow(message):
         "needs_analysis": False
     }
 
-def execute_workflow(message, plan):
-    """Ejecuta el workflow planificado paso a paso"""
+# Pasos del workflow y consultas de clima corren en pools acotados; son
+# pools distintos para que un paso nunca espere a un hilo de su propio pool.
+# El tiempo límite de un paso cuenta desde que empieza a correr, no mientras
+# espera en la cola del pool (compartido por todas las peticiones). Un paso
+# que se pasa del límite no se puede interrumpir: su hilo sigue ocupado
+# hasta que termina, aunque su resultado se descarta.
+WORKFLOW_WORKERS = int(os.environ.get('WORKFLOW_WORKERS', 8))
+STEP_TIMEOUT = int(os.environ.get('WORKFLOW_STEP_TIMEOUT', 30))
+workflow_pool = ThreadPoolExecutor(max_workers=WORKFLOW_WORKERS, thread_name_prefix='workflow')
+lookup_pool = ThreadPoolExecutor(max_workers=WORKFLOW_WORKERS, thread_name_prefix='lookup')
+
+def timed_step(message, step, on_start):
+    """run_step avisando antes a `on_start` de que el paso arrancó"""
+    on_start()
+    return run_step(message, step)
+
+def run_step(message, step):
+    """Ejecuta un paso del workflow y devuelve su resultado"""
+    action = step.get("action", "")
+    params = step.get("params") or {}
+    print(f"🔄 Ejecutando paso {step.get('step', 0)}: {step.get('description', '')}")
+    
+    if action == "multi_weather":
+        return multi_weather_tool(params.get("cities", []))
+    elif action == "batch_calculator":
+        # Extraer operaciones del mensaje
+        return batch_calculator_tool(extract_operations_from_message(message))
+    elif action == "weather":
+        return weather_tool(params.get("city", "Madrid"))
+    elif action == "calculator":
+        return calculator(
+            params.get("operation", "add"),
+            params.get("a", 0),
+            params.get("b", 0)
+        )
+    return None
+
+def step_dependencies(steps):
+    """Grafo de dependencias: step -> pasos que deben terminar antes.
+
+    Se usa `depends_on` si el plan lo trae; si no, cada herramienta solo
+    depende de sus propios parámetros y puede correr en paralelo.
+    """
+    known = {step.get("step") for step in steps}
+    deps = {}
+    for step in steps:
+        depends_on = step.get("depends_on") or []
+        if not isinstance(depends_on, list):
+            depends_on = [depends_on]
+        deps[step["step"]] = {d for d in depends_on if is_step_number(d) and d in known and d != step["step"]}
+    return deps
+
+def is_step_number(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def workflow_steps(plan):
+    """Pasos ejecutables del plan, o None si es una tarea simple"""
+    steps = [
+        step for step in plan.get("workflow", [])
+        if isinstance(step, dict) and step.get("action", "") != "analyze"  # "analyze" lo maneja synthesize_results
+    ]
+    if any(step.get("action") == "simple" for step in steps):
+        return None
+    
+    # Números de paso enteros y únicos aunque el plan del LLM los repita,
+    # los omita o traiga otra cosa (listas, textos...)
+    for index, step in enumerate(steps):
+        if not is_step_number(step.get("step")):
+            step["step"] = index + 1
+    if len({step["step"] for step in steps}) != len(steps):
+        for index, step in enumerate(steps):
+            step["step"] = index + 1
+    return steps
+
+def ordered_results(steps, outcomes):
+    """Resultados en el orden del plan"""
     results = []
+    for step in steps:
+        outcome = outcomes[step["step"]]
+        entry = {"step": step["step"], "action": step.get("action", "")}
+        entry.update(outcome)
+        if 'error' in outcome or outcome.get("result") is not None:
+            results.append(entry)
+    return results
+
+def step_order(deps):
+    """Orden topológico de los pasos; los que quedan fuera están en un ciclo
+    (o dependen de uno) y nunca podrán ejecutarse"""
+    order = []
+    remaining = dict(deps)
+    while True:
+        ready = [num for num, needs in remaining.items() if needs <= set(order)]
+        if not ready:
+            return order
+        for num in ready:
+            order.append(num)
+            del remaining[num]
+
+def execute_workflow(message, plan):
+    """Ejecuta el workflow planificado: los pasos independientes corren a la
+    vez, así que tarda lo que la rama más lenta y no la suma de todas"""
+    steps = workflow_steps(plan)
+    if steps is None:
+        # Ejecutar como antes (modo simple)
+        return execute_with_llm_decision(message)
     
-    for step in plan.get("workflow", []):
-        step_num = step.get("step", 0)
-        action = step.get("action", "")
-        params = step.get("params", {})
-        description = step.get("description", "")
+    deps = step_dependencies(steps)
+    outcomes = {}  # step -> resultado o error
+    pending = {step["step"]: step for step in steps}
+    running = {}   # future -> step
+    started = {}   # step -> cuándo empezó a correr
+    
+    while pending or running:
+        # Lanzar todo lo que ya tiene sus dependencias resueltas
+        for num, step in list(pending.items()):
+            if not deps[num] <= outcomes.keys():
+                continue
+            del pending[num]
+            failed = [d for d in deps[num] if 'error' in outcomes[d]]
+            if failed:
+                outcomes[num] = {"error": f"Omitido: falló el paso {failed[0]}"}
+                continue
+            future = workflow_pool.submit(timed_step, message, step,
+                                          lambda num=num: started.setdefault(num, time.monotonic()))
+            running[future] = num
         
-        print(f"🔄 Ejecutando paso {step_num}: {description}")
+        if not running:
+            if pending:
+                # Dependencias circulares: no hay nada que se pueda ejecutar
+                for num in pending:
+                    outcomes[num] = {"error": "Dependencia circular"}
+                pending.clear()
+            break
         
-        if action == "multi_weather":
-            cities = params.get("cities", [])
-            result = multi_weather_tool(cities)
-            results.append({"step": step_num, "action": action, "result": result})
-            
-        elif action == "batch_calculator":
-            # Extraer operaciones del mensaje
-            operations = extract_operations_from_message(message)
-            result = batch_calculator_tool(operations)
-            results.append({"step": step_num, "action": action, "result": result})
-            
-        elif action == "weather":
-            city = params.get("city", "Madrid")
-            result = weather_tool(city)
-            results.append({"step": step_num, "action": action, "result": result})
-            
-        elif action == "calculator":
-            result = calculator(
-                params.get("operation", "add"),
-                params.get("a", 0),
-                params.get("b", 0)
-            )
-            results.append({"step": step_num, "action": action, "result": result})
-            
-        elif action == "analyze":
-            # Este paso se maneja en synthesize_results
-            continue
-            
-        elif action == "simple":
-            # Ejecutar como antes (modo simple)
-            return execute_with_llm_decision(message)
+        # Un paso que arranque durante la espera vence después de STEP_TIMEOUT,
+        # así que nunca hace falta esperar más que eso para revisar plazos
+        now = time.monotonic()
+        deadlines = [started[num] + STEP_TIMEOUT for num in running.values() if num in started]
+        timeout = min(deadlines + [now + STEP_TIMEOUT]) - now
+        done, _ = wait(running, timeout=max(0, timeout), return_when=FIRST_COMPLETED)
+        for future in done:
+            num = running.pop(future)
+            try:
+                outcomes[num] = {"result": future.result()}
+            except Exception as e:
+                outcomes[num] = {"error": str(e)}
+        now = time.monotonic()
+        for future, num in list(running.items()):
+            if num in started and now >= started[num] + STEP_TIMEOUT:
+                # cancel() solo evita que arranque; un hilo ya en marcha no se
+                # puede interrumpir, pero su resultado se descarta
+                future.cancel()
+                del running[future]
+                outcomes[num] = {"error": f"Tiempo agotado ({STEP_TIMEOUT}s)"}
+                print(f"⏱️ Paso {num} cancelado por tiempo")
+    
+    results = ordered_results(steps, outcomes)
     
     # Si necesita análisis, sintetizar resultados
     if plan.get("needs_analysis", False):
@@ -475,7 +957,6 @@ def execute_workflow(message, plan):
 
 def extract_operations_from_message(message):
     """Extrae operaciones matemáticas del mensaje"""
-    import re
     
     # Buscar patrones como "5+3, 10-2, 8*4"
     patterns = re.findall(r'(\d+)\s*([+\-*/])\s*(\d+)', message)
@@ -492,7 +973,6 @@ def extract_operations_from_message(message):
     
     # Si no encuentra patrones, crear operaciones ejemplo
     if not operations:
-        import re
         numbers = re.findall(r'\d+', message)
         if len(numbers) >= 2:
             for i in range(0, len(numbers)-1, 2):
@@ -504,8 +984,8 @@ def extract_operations_from_message(message):
     
     return operations[:5]  # Máximo 5 operaciones
 
-def synthesize_results(original_message, workflow_results):
-    """El LLM analiza todos los resultados y genera una respuesta inteligente"""
+def synthesis_request(original_message, workflow_results):
+    """Petición a Ollama para analizar todos los resultados del workflow"""
     
     # Preparar contexto de resultados
     context = f"El usuario preguntó: '{original_message}'\n\nResultados obtenidos:\n"
@@ -527,32 +1007,24 @@ INSTRUCCIONES:
 
 Respuesta analizada:"""
 
-    try:
-        response = requests.post(
-            'http://127.0.0.1:11434/api/generate',
-            json={
-                'model': 'phi',
-                'prompt': synthesis_prompt,
-                'stream': False,
-                'options': {
-                    'temperature': 0.7,
-                    'num_predict': 250
-                }
-            },
-            timeout=150
-        )
-        
-        if response.status_code == 200:
-            analysis = response.json()['response']
-            return {
-                'tool_used': 'workflow_composition',
-                'workflow_steps': len(workflow_results),
-                'result': workflow_results,
-                'response': f"🔗 Análisis compuesto: {analysis}"
-            }
-    except Exception as e:
-        print(f"❌ Error en síntesis: {e}")
-    
+    return {
+        'prompt': synthesis_prompt,
+        'options': {
+            'temperature': 0.7,
+            'num_predict': 250
+        },
+        'timeout': SYNTHESIS_TIMEOUT
+    }
+
+def synthesis_response(analysis, workflow_results):
+    return {
+        'tool_used': 'workflow_composition',
+        'workflow_steps': len(workflow_results),
+        'result': workflow_results,
+        'response': f"🔗 Análisis compuesto: {analysis}"
+    }
+
+def synthesis_fallback(workflow_results):
     # Fallback: respuesta simple
     return {
         'tool_used': 'workflow_basic',
@@ -561,42 +1033,52 @@ Respuesta analizada:"""
         'response': f"Ejecuté {len(workflow_results)} pasos. Resultados disponibles."
     }
 
-def generate_llm_response(message):
-    """Genera respuesta directa con el LLM sin usar herramientas"""
+def synthesize_results(original_message, workflow_results):
+    """El LLM analiza todos los resultados y genera una respuesta inteligente"""
     try:
-        response = requests.post(
-            'http://localhost:11434/api/generate',
-            json={
-                'model': 'phi',
-                'prompt': f"Eres un asistente amigable. Responde de forma concisa.\n\nUsuario: {message}\nAsistente:",
-                'stream': False,
-                'options': {
-                    'temperature': 0.7,
-                    'num_predict': 100
-                }
-            },
-            timeout=150
-        )
-        
-        if response.status_code == 200:
-            llm_text = response.json()['response']
-            return {
-                'tool_used': 'direct_llm',
-                'result': llm_text,
-                'response': f"🤖 {llm_text}"
-            }
-        else:
-            return {
-                'tool_used': None,
-                'result': None,
-                'response': "❌ Error al generar respuesta con LLM"
-            }
-    except Exception as e:
+        analysis = ollama.generate(**synthesis_request(original_message, workflow_results))
+        return synthesis_response(analysis, workflow_results)
+    except OllamaError as e:
+        print(f"❌ Error en síntesis: {e}")
+    return synthesis_fallback(workflow_results)
+
+def response_request(message):
+    """Petición a Ollama para responder sin usar herramientas"""
+    return {
+        'prompt': f"Eres un asistente amigable. Responde de forma concisa.\n\nUsuario: {message}\nAsistente:",
+        'options': {
+            'temperature': 0.7,
+            'num_predict': 100
+        },
+        'timeout': RESPONSE_TIMEOUT
+    }
+
+def llm_response(llm_text):
+    return {
+        'tool_used': 'direct_llm',
+        'result': llm_text,
+        'response': f"🤖 {llm_text}"
+    }
+
+def llm_error_response(e):
+    if e.status_code is not None:
         return {
             'tool_used': None,
             'result': None,
-            'response': "❌ Error de conexión con Ollama. ¿Está iniciado?"
+            'response': "❌ Error al generar respuesta con LLM"
         }
+    return {
+        'tool_used': None,
+        'result': None,
+        'response': "❌ Error de conexión con Ollama. ¿Está iniciado?"
+    }
+
+def generate_llm_response(message):
+    """Genera respuesta directa con el LLM sin usar herramientas"""
+    try:
+        return llm_response(ollama.generate(**response_request(message)))
+    except OllamaError as e:
+        return llm_error_response(e)
     
 # ============ HERRAMIENTAS DE AGREGACIÓN ============
 def multi_weather_tool(cities):
@@ -606,11 +1088,15 @@ def multi_weather_tool(cities):
     if isinstance(cities, str):
         cities = [cities]
     
-    for city in cities[:5]:  # Máximo 5 ciudades para no sobrecargar
+    # Máximo 5 ciudades para no sobrecargar; se consultan a la vez
+    cities = cities[:5]
+    futures = [lookup_pool.submit(weather_tool, city) for city in cities]
+    deadline = time.monotonic() + STEP_TIMEOUT
+    for city, future in zip(cities, futures):
         try:
-            weather_data = weather_tool(city)
-            results[city] = weather_data
+            results[city] = future.result(timeout=max(0, deadline - time.monotonic()))
         except Exception as e:
+            future.cancel()
             results[city] = {"error": f"No se pudo obtener clima de {city}"}
     
     return {
@@ -824,17 +1310,28 @@ def health_compose():
 def health_ollama():
     """Verificar si Ollama está disponible"""
     try:
-        response = requests.get('http://localhost:11434/api/tags', timeout=150)
-        if response.status_code == 200:
-            models = response.json().get('models', [])
-            return jsonify({
-                "ollama_status": "disponible",
-                "models": [m['name'] for m in models]
-            })
-    except:
+        models = ollama.tags()
+        return jsonify({
+            "ollama_status": "disponible",
+            "models": [m['name'] for m in models],
+            "circuit": ollama.breaker.state(),
+            "cache": ollama.cache.stats()
+        })
+    except OllamaError:
         pass
     
-    return jsonify({"ollama_status": "no disponible"}), 503
+    return jsonify({"ollama_status": "no disponible", "circuit": ollama.breaker.state(),
+                    "cache": ollama.cache.stats()}), 503
+
+@app.route('/router-stats', methods=['GET'])
+def router_stats_endpoint():
+    """Aciertos y latencia por nivel del router de /chat-llm"""
+    return jsonify(router_stats.snapshot())
+
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    """Métricas de la caché de respuestas de Ollama"""
+    return jsonify(ollama.cache.stats())
 
 @app.route('/')
 def home():